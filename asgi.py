@@ -0,0 +1,15 @@
+"""
+The stream gateway, an ASGI application serving the stream endpoints.
+
+It runs with uvicorn next to the wsgi application, as the `gateway`
+process of the Procfile:
+
+    uvicorn asgi:app --host 0.0.0.0 --port $GATEWAY_PORT --proxy-headers
+
+and the proxy in front of both routes `/chat/stream/` to it. Every other
+path answers 404.
+"""
+from cookgpt import create_app_wsgi
+from cookgpt.chatbot.gateway import StreamGateway
+
+app = application = StreamGateway(create_app_wsgi())  # noqa
@@ -1,18 +1,20 @@
 """Callbacks for the chatbot."""
 
-from typing import Any, Dict, List, cast
+from typing import Any, Dict, List, Optional, cast
 from uuid import UUID
 
 from langchain.callbacks import OpenAICallbackHandler
 from langchain.schema import BaseMessage, ChatGeneration, LLMResult
 
 from cookgpt import logging
+from cookgpt.chatbot.stream import StreamWriter
 from cookgpt.chatbot.utils import (
     convert_message_to_dict,
+    count_message_tokens,
     num_tokens_from_messages,
 )
 from cookgpt.ext.config import config
-from cookgpt.globals import getvar, response, setvar, user
+from cookgpt.globals import getvar, setvar, user
 from cookgpt.utils import utcnow
 
 
@@ -23,6 +25,12 @@ class ChatCallbackHandler(OpenAICallbackHandler):
     verbose: bool = config.LANGCHAIN_VERBOSE
     _query_cost: int = 0
     raise_error = True
+    # prompt messages whose cost was cached and that had to be encoded
+    prompt_cost_hits: int = 0
+    prompt_cost_misses: int = 0
+    # stream entries saved by batching the tokens of the responses
+    stream_entries_saved: int = 0
+    _stream_writer: "Optional[StreamWriter]" = None
 
     def compute_completion_tokens(self, result: LLMResult, model_name: str):
         """Compute the cost of the result."""
@@ -53,7 +61,10 @@ class ChatCallbackHandler(OpenAICallbackHandler):
         messages_raw = []
         messages_raw = [convert_message_to_dict(m) for m in messages]
         # logging.debug("Messages: %s", messages_raw)
-        num_tokens = num_tokens_from_messages(messages_raw, model_name)
+        count = count_message_tokens(messages_raw, model_name)
+        num_tokens = count.tokens
+        self.prompt_cost_hits += count.hits
+        self.prompt_cost_misses += count.misses
         # prompt_cost = get_openai_token_cost_for_model(model_name, num_tokens)
         # logging.debug("Prompt cost: %s", prompt_cost)
         # self.total_tokens += num_tokens
@@ -109,18 +120,35 @@ class ChatCallbackHandler(OpenAICallbackHandler):
         Run on new LLM token.
         Only available when streaming is enabled.
         """
-        from cookgpt.chatbot.utils import get_stream_name
-        from cookgpt.globals import current_app as app
-
         if self.verbose:  # pragma: no cover
             print(token, end="", flush=True)
-        assert response, "No response found."
-        stream = get_stream_name(user, response)
-        app.redis.xadd(
-            stream,
-            {"token": token, "count": 1},
-            maxlen=1000,
-        )
+        writer = self.get_stream_writer()
+        assert writer, "No response found."
+        writer.write(token)
+
+    def get_stream_writer(self) -> "Optional[StreamWriter]":
+        """get the writer of the response's stream"""
+        from cookgpt.chatbot.models import Chat
+        from cookgpt.chatbot.utils import get_stream_name
+
+        if self._stream_writer is None:
+            response = getvar("response", Chat, None)
+            if response is None:
+                return None
+            stream = get_stream_name(user, response)
+            self._stream_writer = StreamWriter(stream)
+        return self._stream_writer
+
+    def end_stream(self, error: Optional[BaseException] = None):
+        """
+        Flush the buffered tokens and add the end of stream sentinel to
+        the response's stream, readers stop reading when they get to it.
+        """
+        writer = self.get_stream_writer()
+        if writer is None or writer.closed:
+            return
+        writer.close(error)
+        self.stream_entries_saved += writer.entries_saved
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """tracks the cost of the conversation"""
@@ -132,6 +160,16 @@ class ChatCallbackHandler(OpenAICallbackHandler):
         )
         self.compute_completion_tokens(response, "gpt-3.5-turbo-0613")
 
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        """ends the stream of the response"""
+        logging.error("LLM error: %s", error)
+        self.end_stream(error)
+
+    def on_chain_error(self, error: BaseException, **kwargs: Any) -> None:
+        """ends the stream of the response"""
+        logging.error("Chain error: %s", error)
+        self.end_stream(error)
+
     def register(self):
         """register the callback handler"""
         from langchain.callbacks.manager import openai_callback_var
@@ -12,19 +12,21 @@ from pydantic import Field, root_validator
 from cookgpt import logging
 from cookgpt.chatbot.data.fake_data import responses
 from cookgpt.chatbot.data.prompts import prompt as PROMPT
-from cookgpt.chatbot.memory import BaseMemory, ThreadMemory
+from cookgpt.chatbot.memory import BaseMemory, get_memory
 from cookgpt.ext.config import config
 from cookgpt.globals import getvar, setvar
 
 
-def get_llm() -> BaseChatModel:  # pragma: no cover
+def get_llm(streaming: Optional[bool] = None) -> BaseChatModel:
     """returns the language model"""
     llm_cls: Type[LLM | FakeLLM]
-    if config.USE_OPENAI:
+    if config.USE_OPENAI:  # pragma: no cover
         llm_cls = LLM
     else:
         llm_cls = FakeLLM
-    return llm_cls(streaming=config.OPENAI_STREAMING)
+    if streaming is None:
+        streaming = config.OPENAI_STREAMING
+    return llm_cls(streaming=streaming)
 
 
 def get_chain_input_key() -> str:
@@ -85,7 +87,7 @@ class ThreadChain(ConversationChain):
     input_key: str = Field(default_factory=get_chain_input_key)
     llm: "BaseChatModel" = Field(default_factory=get_llm)
     prompt: "BasePromptTemplate" = PROMPT
-    memory: "BaseMemory" = Field(default_factory=ThreadMemory)
+    memory: "BaseMemory" = Field(default_factory=get_memory)
 
     @root_validator
     def set_context(cls, values):
@@ -0,0 +1,87 @@
+"""Chatbot commands"""
+from typing import Optional
+from uuid import UUID
+
+import click
+from sqlalchemy import select, update
+
+from cookgpt import logging
+from cookgpt.chatbot import app
+from cookgpt.chatbot.memory import make_message
+from cookgpt.chatbot.models import Chat, Thread
+from cookgpt.chatbot.utils import convert_message_to_dict, count_message_tokens
+from cookgpt.ext.cache import cache, thread_cache_key, threads_cache_key
+from cookgpt.ext.database import db
+
+
+@app.cli.command("reconcile-threads")
+@click.option(
+    "--batch-size",
+    "-b",
+    default=500,
+    show_default=True,
+    help="number of threads to reconcile per transaction",
+)
+def reconcile_threads(batch_size: int):
+    """Recompute the cost, chat count and last chat of all threads"""
+    total = 0
+    last_id: Optional[UUID] = None
+    while True:
+        stmt = select(Thread.id, Thread.user_id).order_by(Thread.id)
+        if last_id is not None:
+            stmt = stmt.where(Thread.id > last_id)
+        rows = db.session.execute(stmt.limit(batch_size)).all()
+        if not rows:
+            break
+        thread_ids = [row.id for row in rows]
+        Thread.reconcile(thread_ids)
+        db.session.commit()
+        cache.delete_many(
+            *[thread_cache_key(thread_id=row.id) for row in rows],
+            *{threads_cache_key(user_id=row.user_id) for row in rows},
+        )
+        total += len(rows)
+        last_id = thread_ids[-1]
+        logging.debug("Reconciled %d threads", total)
+    click.echo(f"Reconciled {total} threads")
+
+
+@app.cli.command("count-chat-tokens")
+@click.option(
+    "--batch-size",
+    "-b",
+    default=1000,
+    show_default=True,
+    help="number of chats to count per transaction",
+)
+def count_chat_tokens(batch_size: int):
+    """Count the tokens of the chats that were stored without them"""
+    total = 0
+    last_id: Optional[UUID] = None
+    while True:
+        stmt = (
+            select(Chat.id, Chat.content, Chat.chat_type)
+            .where(Chat.content_tokens.is_(None), Chat.content != "")
+            .order_by(Chat.id)
+        )
+        if last_id is not None:
+            stmt = stmt.where(Chat.id > last_id)
+        rows = db.session.execute(stmt.limit(batch_size)).all()
+        if not rows:
+            break
+        messages = [
+            convert_message_to_dict(make_message(*row)) for row in rows
+        ]
+        costs = count_message_tokens(messages).costs
+        db.session.execute(
+            update(Chat),
+            [
+                {"id": row.id, "content_tokens": cost}
+                for row, cost in zip(rows, costs)
+            ],
+        )
+        db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+        logging.debug("Counted the tokens of %d chats", total)
+    click.echo(f"Counted the tokens of {total} chats")
@@ -39,8 +39,8 @@ class Chat:
 
 class Chats:
     class Get:
-        QueryParams = {"thread_id": Uuid}
-        Response = {"chats": [ChatExample]}
+        QueryParams = {"thread_id": Uuid, "limit": 50, "before": 52}
+        Response = {"chats": [ChatExample], "next_cursor": 2}
         NotFound = {"message": "thread not found"}
 
     class Delete:
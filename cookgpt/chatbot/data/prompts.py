@@ -1,16 +1,62 @@
 # ruff: noqa
+import re
+from functools import lru_cache
+from hashlib import sha1
 from pathlib import Path
+from typing import Any
 
 from langchain.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
+from langchain.schema import BaseMessage, SystemMessage
 
 from cookgpt.ext.config import config
 
-system_prompt_template = SystemMessagePromptTemplate.from_template_file(
-    Path(__file__).parent / "templates" / "system_prompt.txt",
+SYSTEM_PROMPT_PATH = Path(__file__).parent / "templates" / "system_prompt.txt"
+SYSTEM_PROMPT_VARIABLE = "{user}"
+
+system_prompt = SYSTEM_PROMPT_PATH.read_text()
+# identifies the version of the template, anything derived from the
+# template is cached under it
+system_prompt_hash = sha1(system_prompt.encode()).hexdigest()[:12]
+# the static parts of the template, the user's name goes between them
+system_prompt_parts = tuple(system_prompt.split(SYSTEM_PROMPT_VARIABLE))
+# for counting, the template is cut at the spaces around the words that
+# hold the user's name. BPE doesn't merge tokens across the space that
+# starts a word, so the static text and the words are counted apart
+# exactly. Punctuation takes the newlines that follow it into its token,
+# so they stay with the word
+SYSTEM_PROMPT_NAME_WORD = re.compile(r"( ?\S*\{user\}\S*[\r\n]*)")
+
+
+def split_system_prompt(template: str) -> "tuple[tuple[str, ...], ...]":
+    """split a template into its static parts and the words with the name"""
+    pieces = SYSTEM_PROMPT_NAME_WORD.split(template)
+    return tuple(pieces[0::2]), tuple(pieces[1::2])
+
+
+system_prompt_static_parts, system_prompt_name_words = split_system_prompt(
+    system_prompt
+)
+
+
+@lru_cache(maxsize=1024)
+def render_system_prompt(user: str) -> str:
+    """render the system prompt for a user"""
+    return user.join(system_prompt_parts)
+
+
+class SystemPromptTemplate(SystemMessagePromptTemplate):
+    """a system message template that renders once per user"""
+
+    def format(self, **kwargs: Any) -> BaseMessage:
+        return SystemMessage(content=render_system_prompt(kwargs["user"]))
+
+
+system_prompt_template = SystemPromptTemplate.from_template_file(
+    SYSTEM_PROMPT_PATH,
     input_variables=["user"],
 )
 
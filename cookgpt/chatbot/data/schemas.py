@@ -1,7 +1,8 @@
 """Chatbot data validation schemas."""
 from typing import TYPE_CHECKING, Any
 
-from apiflask import Schema, fields
+from apiflask import Schema, fields, validators
+from marshmallow import ValidationError, validates_schema
 
 from cookgpt.utils import make_field
 
@@ -137,6 +138,35 @@ class Chats:
                 metadata={"description": "id of thread to get chats from"},
                 required=True,
             )
+            limit = fields.Integer(
+                load_default=50,
+                validate=validators.Range(min=1, max=100),
+                metadata={
+                    "description": "maximum number of chats to return",
+                    "example": 50,
+                },
+            )
+            before = fields.Integer(
+                metadata={
+                    "description": "only return chats sent before this cursor",
+                    "example": 52,
+                },
+            )
+            after = fields.Integer(
+                metadata={
+                    "description": "only return chats sent after this cursor",
+                    "example": 2,
+                },
+            )
+
+            @validates_schema
+            def validate_cursor(self, data, **kwargs):
+                """only one of `before` and `after` can be used"""
+                if "before" in data and "after" in data:
+                    raise ValidationError(
+                        "only one of 'before' and 'after' can be given",
+                        "after",
+                    )
 
         class Response(Schema):
             chats = fields.List(
@@ -146,6 +176,17 @@ class Chats:
                     "example": [ex.ChatExample, ex.ChatExample],
                 },
             )
+            next_cursor = fields.Integer(
+                allow_none=True,
+                metadata={
+                    "description": (
+                        "cursor of the next page, use it as `before` (or "
+                        "as `after` if `after` was given). It is null on "
+                        "the last page."
+                    ),
+                    "example": 2,
+                },
+            )
 
     class Delete:
         class Body(Schema):
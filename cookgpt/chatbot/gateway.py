@@ -0,0 +1,428 @@
+"""
+An asyncio gateway serving the stream endpoints.
+
+The flask views hold a worker thread for as long as a response is being
+streamed. The gateway is an ASGI application that serves the same
+endpoints from a single event loop:
+
+GET /chat/stream/<chat id>
+    the response as plain text
+GET /chat/stream/<chat id>/events
+    the response as server-sent events, see `read_stream_events`
+
+The requests are authenticated with the same access tokens as the api,
+sent in the `Authorization` header or in the `access_token` query
+parameter (`EventSource` can't set headers).
+
+All the streams read by a process are multiplexed over one blocking
+XREAD by a `StreamHub`, so idle connections only cost a queue each. A
+subscriber that doesn't keep up with its queue is paused, and catches up
+from its last entry once it has drained it.
+"""
+import asyncio
+import re
+from typing import TYPE_CHECKING, Any, Callable, Optional
+from urllib.parse import parse_qs
+from uuid import UUID
+
+from redis.asyncio import BlockingConnectionPool, Redis
+
+from cookgpt import logging
+from cookgpt.chatbot.stream import format_comment, format_event, get_start_id
+
+if TYPE_CHECKING:
+    from cookgpt.app import App
+
+    Entry = tuple[bytes, dict[bytes, bytes]]
+    Scope = dict[str, Any]
+    Receive = Callable[[], Any]
+    Send = Callable[[dict], Any]
+
+ROUTE = re.compile(
+    r"^/chat/stream/(?P<chat_id>[0-9a-fA-F-]{32,36})(?P<events>/events)?/?$"
+)
+
+
+def parse_entry_id(entry_id: "bytes | str") -> "tuple[int, int]":
+    """parse a stream entry id so that it can be compared"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class Subscription:
+    """the entries of a stream read by a single client"""
+
+    def __init__(self, hub: "StreamHub", stream: str, position: str):
+        self.hub = hub
+        self.stream = stream
+        # the id of the last entry given to the subscription
+        self.position = position
+        self.queue: "asyncio.Queue[Entry]" = asyncio.Queue(hub.queue_size)
+        self.paused = False
+
+    async def get(self) -> "Entry":
+        """wait for the next entry"""
+        entry = await self.queue.get()
+        if self.paused and self.queue.qsize() <= self.hub.queue_size // 2:
+            # the client has caught up, read the stream for it again
+            self.paused = False
+        return entry
+
+    def offer(self, entry: "Entry") -> bool:
+        """add an entry to the queue, pausing the subscription if it is full"""
+        if parse_entry_id(entry[0]) <= parse_entry_id(self.position):
+            return True
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            logging.debug("Pausing slow subscriber of %s", self.stream)
+            self.paused = True
+            return False
+        self.position = entry[0].decode()
+        return True
+
+    def close(self):
+        """stop receiving entries"""
+        self.hub.unsubscribe(self)
+
+
+class StreamHub:
+    """
+    Reads the streams of all the subscriptions of a process with one
+    blocking XREAD at a time.
+
+    A new subscription is picked up by the next XREAD, at most `block_ms`
+    milliseconds later.
+    """
+
+    def __init__(
+        self,
+        redis: "Redis",
+        block_ms: int = 100,
+        queue_size: int = 64,
+        count: int = 100,
+    ):
+        self.redis = redis
+        self.block_ms = block_ms
+        self.queue_size = queue_size
+        self.count = count
+        self.subscriptions: "dict[str, set[Subscription]]" = {}
+        # the XREADs sent, and those of them that returned entries
+        self.reads = 0
+        self.hits = 0
+        self._task: "Optional[asyncio.Task]" = None
+
+    def subscribe(self, stream: str, position: str = "0-0") -> Subscription:
+        """read a stream after the entry with the id `position`"""
+        subscription = Subscription(self, stream, position)
+        self.subscriptions.setdefault(stream, set()).add(subscription)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """stop reading a stream for a subscription"""
+        subscriptions = self.subscriptions.get(subscription.stream, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscriptions.pop(subscription.stream, None)
+
+    def get_positions(self) -> "dict[str, str]":
+        """get the position to read each stream from"""
+        positions: "dict[str, str]" = {}
+        for stream, subscriptions in self.subscriptions.items():
+            active = [s.position for s in subscriptions if not s.paused]
+            if active:
+                positions[stream] = min(active, key=parse_entry_id)
+        return positions
+
+    async def run(self):
+        """read the streams until there are no subscriptions left"""
+        while self.subscriptions:
+            positions = self.get_positions()
+            if not positions:
+                # every subscriber is paused
+                await asyncio.sleep(self.block_ms / 1000)
+                continue
+            try:
+                self.reads += 1
+                result = await self.redis.xread(
+                    positions,  # type: ignore[arg-type]
+                    count=self.count,
+                    block=self.block_ms,
+                )
+            except Exception as error:  # pragma: no cover
+                logging.error("Failed to read streams: %s", error)
+                await asyncio.sleep(1)
+                continue
+            if result:
+                self.hits += 1
+            for stream, entries in result or []:
+                for subscription in list(
+                    self.subscriptions.get(stream.decode(), ())
+                ):
+                    if subscription.paused:
+                        continue
+                    for entry in entries:
+                        if not subscription.offer(entry):
+                            break
+
+    async def close(self):
+        """stop reading the streams"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.subscriptions.clear()
+
+
+def connect(app: "App") -> "Redis":
+    """
+    connect to redis through a pool of `CHATBOT_GATEWAY_REDIS_CONNECTIONS`,
+    a burst of requests waits for a free connection instead of opening one
+    per request
+    """
+    pool = BlockingConnectionPool.from_url(
+        app.config.REDIS_URL,
+        max_connections=app.config.CHATBOT_GATEWAY_REDIS_CONNECTIONS,
+        timeout=app.config.REDIS_POOL_TIMEOUT,
+    )
+    return Redis(connection_pool=pool)
+
+
+class StreamGateway:
+    """The ASGI application serving the stream endpoints"""
+
+    def __init__(self, app: "App", redis: "Optional[Redis]" = None):
+        self.app = app
+        self.config = app.config
+        self.redis = redis or connect(app)
+        self.hub = StreamHub(
+            self.redis,
+            block_ms=app.config.CHATBOT_GATEWAY_BLOCK_MS,
+            queue_size=app.config.CHATBOT_GATEWAY_QUEUE_SIZE,
+        )
+
+    async def __call__(self, scope: "Scope", receive: "Receive", send: "Send"):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive: "Receive", send: "Send"):
+        """handle the startup and shutdown of the server"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.hub.close()
+                await self.redis.aclose()
+                await self.redis.connection_pool.disconnect()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def authenticate(self, token: str) -> "Optional[UUID]":
+        """
+        get the id of the user an access token belongs to, the token goes
+        through the same checks as `auth_required()`
+        """
+        from flask_jwt_extended import get_current_user, verify_jwt_in_request
+
+        headers = {"Authorization": f"Bearer {token}"}
+        with self.app.test_request_context(headers=headers):
+            try:
+                verify_jwt_in_request()
+            except Exception:
+                return None
+            return get_current_user().id
+
+    def get_chat(self, chat_id: UUID) -> "Optional[dict[str, Any]]":
+        """get the chat and the name of its stream"""
+        from cookgpt.chatbot.data import schemas as sc
+        from cookgpt.chatbot.models import Chat
+        from cookgpt.chatbot.utils import get_stream_name
+        from cookgpt.ext.database import db
+
+        with self.app.app_context():
+            chat = db.session.get(Chat, chat_id)
+            if chat is None:
+                return None
+            return {
+                "user_id": chat.thread.user_id,
+                "content": chat.content,
+                "stream": get_stream_name(chat.thread.user, chat),
+                "data": sc.ChatSchema().dumps(sc.parse_chat(chat)),
+            }
+
+    async def handle(self, scope: "Scope", receive: "Receive", send: "Send"):
+        """serve a request"""
+        match = ROUTE.match(scope["path"])
+        if not match:
+            return await self.respond(send, 404, "Not found")
+        if scope["method"] != "GET":
+            return await self.respond(send, 405, "Method not allowed")
+        headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
+        query = parse_qs(scope.get("query_string", b"").decode())
+
+        token = headers.get("authorization", "").removeprefix("Bearer ")
+        token = token or query.get("access_token", [""])[0]
+        user_id = None
+        if token:
+            user_id = await asyncio.to_thread(self.authenticate, token)
+        if user_id is None:
+            return await self.respond(send, 401, "Not authenticated")
+        try:
+            chat_id = UUID(match["chat_id"])
+        except ValueError:
+            return await self.respond(send, 404, "Chat does not exist.")
+        chat = await asyncio.to_thread(self.get_chat, chat_id)
+        if chat is None:
+            return await self.respond(send, 404, "Chat does not exist.")
+        if chat["user_id"] != user_id:
+            return await self.respond(
+                send, 403, "Chat belongs to another user."
+            )
+
+        stream = chat["stream"]
+        streaming = chat["content"] == "" and bool(
+            await self.redis.exists(f"{stream}:task")
+        )
+        if match["events"]:
+            start_id = get_start_id(headers.get("last-event-id"))
+            events = self.get_events(chat_id, stream, start_id, streaming)
+            content_type = "text/event-stream"
+        elif streaming:
+            events = self.get_tokens(stream)
+            content_type = "text/plain; charset=utf-8"
+        else:
+            return await self.respond(send, 200, chat["content"])
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", content_type.encode()),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        await self.send_events(events, receive, send)
+
+    async def respond(self, send: "Send", status: int, body: str):
+        """send a whole response"""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body.encode()})
+
+    async def send_events(self, events, receive: "Receive", send: "Send"):
+        """send the chunks of a response until it ends or the client leaves"""
+
+        async def wait_for_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            while True:
+                chunk = asyncio.ensure_future(anext(events))
+                await asyncio.wait(
+                    {chunk, disconnect}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnect.done():
+                    # let the generator unwind before it is closed
+                    chunk.cancel()
+                    await asyncio.gather(chunk, return_exceptions=True)
+                    return
+                try:
+                    body = chunk.result()
+                except StopAsyncIteration:
+                    break
+                # waits while the client is slow to receive
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": body.encode(),
+                        "more_body": True,
+                    }
+                )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnect.cancel()
+            await events.aclose()
+
+    async def read(self, stream: str, start_id: str, streaming: bool):
+        """
+        yield the entries of a stream, waiting for new entries while it is
+        being streamed
+        """
+        if not streaming:
+            # the stream is complete (or gone), read what is left of it
+            entries = await self.redis.xrange(stream, f"({start_id}", "+")
+            for entry in entries:
+                yield entry
+            return
+        subscription = self.hub.subscribe(stream, start_id)
+        heartbeat = self.config.CHATBOT_STREAM_HEARTBEAT
+        idle = 0
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.get(), heartbeat)
+                    idle = 0
+                except asyncio.TimeoutError:
+                    idle += heartbeat
+                    if idle >= self.config.CHATBOT_STREAM_TIMEOUT:
+                        logging.warning(
+                            "No entries in %r for %ds", stream, idle
+                        )
+                        return
+                    yield None
+        finally:
+            subscription.close()
+
+    async def get_tokens(self, stream: str):
+        """yield the tokens of a response being streamed"""
+        async for entry in self.read(stream, "0-0", streaming=True):
+            if entry is None:
+                continue
+            _, data = entry
+            if b"event" in data:
+                return
+            yield data[b"token"].decode()
+
+    async def get_events(
+        self, chat_id: UUID, stream: str, start_id: str, streaming: bool
+    ):
+        """yield the server-sent events of a response"""
+        async for entry in self.read(stream, start_id, streaming):
+            if entry is None:
+                yield format_comment("heartbeat")
+                continue
+            entry_id, data = entry
+            if data.get(b"event") == b"error":
+                error = data[b"error"].decode()
+                yield format_event("error", {"error": error}, entry_id)
+                return
+            if data.get(b"event") == b"end":
+                chat = await asyncio.to_thread(self.get_chat, chat_id)
+                yield format_event("done", chat and chat["data"], entry_id)
+                return
+            token = {
+                "token": data[b"token"].decode(),
+                "count": int(data[b"count"]),
+            }
+            yield format_event("token", token, entry_id)
+        if not streaming:
+            chat = await asyncio.to_thread(self.get_chat, chat_id)
+            yield format_event("done", chat and chat["data"])
@@ -0,0 +1,115 @@
+"""
+A write-through copy of the messages of active threads kept in redis.
+
+Each thread has a list at `history:<thread id>` with a compact json array
+per message: `[id, chat type, content, tokens]`. Messages are appended as
+the memory saves them and the list expires once the thread has been idle
+for `CHATBOT_HISTORY_TTL` seconds, after which it is rebuilt from the
+database. Setting `CHATBOT_HISTORY_TTL` to 0 disables the list.
+
+Anything that changes the messages of a thread in another way (creating
+chats with content, deleting or archiving chats) drops the list.
+"""
+import json
+from typing import TYPE_CHECKING, Optional, Sequence
+from uuid import UUID
+
+from cookgpt.chatbot.data.enums import MessageType
+from cookgpt.ext.cache import cache
+from cookgpt.ext.config import config
+from cookgpt.globals import current_app as app
+
+if TYPE_CHECKING:
+    HistoryEntry = tuple[str, MessageType, str, Optional[int]]
+
+
+def get_history_key(thread_id: UUID) -> str:
+    """get the key of a thread's history list"""
+    return f"history:{thread_id.hex}"
+
+
+def get_history_ttl() -> int:
+    """get the seconds an idle history list is kept"""
+    return config.CHATBOT_HISTORY_TTL
+
+
+def dump_entry(
+    id: "UUID | str",
+    chat_type: MessageType,
+    content: str,
+    tokens: Optional[int] = None,
+) -> str:
+    """serialize a message for the history list"""
+    return json.dumps(
+        [str(id), chat_type.value, content, tokens], separators=(",", ":")
+    )
+
+
+def load_entry(entry: "bytes | str") -> "HistoryEntry":
+    """deserialize a message from the history list"""
+    id, chat_type, content, tokens = json.loads(entry)
+    return id, MessageType(chat_type), content, tokens
+
+
+def get_cached_tokens(ids: "Sequence[UUID | str]") -> "list[Optional[int]]":
+    """get the token counts cached when the messages were sent"""
+    if not ids:
+        return []
+    return cache.get_many(*(f"chat:{id}:cost" for id in ids))
+
+
+def get_summary_id(thread_id: UUID, order: int) -> str:
+    """get the id of the message holding a thread's summary up to `order`"""
+    return f"{thread_id}:summary:{order}"
+
+
+def forget_summary_cost(thread_id: UUID, order: int):
+    """drop the cached cost of a thread's summary up to `order`"""
+    if order >= 0:
+        cache.delete(f"chat:{get_summary_id(thread_id, order)}:cost")
+
+
+def load_history(thread_id: UUID) -> "Optional[list[HistoryEntry]]":
+    """
+    Get the messages of a thread from its history list.
+
+    Returns None if the thread has no list.
+    """
+    if not get_history_ttl():
+        return None
+    key = get_history_key(thread_id)
+    pipeline = app.redis.pipeline(transaction=False)
+    pipeline.lrange(key, 0, -1)
+    pipeline.expire(key, get_history_ttl())
+    entries, _ = pipeline.execute()
+    if not entries:
+        return None
+    return [load_entry(entry) for entry in entries]
+
+
+def store_history(thread_id: UUID, entries: "Sequence[str]"):
+    """replace the history list of a thread"""
+    if not get_history_ttl() or not entries:
+        return
+    key = get_history_key(thread_id)
+    pipeline = app.redis.pipeline()
+    pipeline.delete(key)
+    pipeline.rpush(key, *entries)
+    pipeline.expire(key, get_history_ttl())
+    pipeline.execute()
+
+
+def append_history(thread_id: UUID, entry: str):
+    """add a message to the history list of a thread, if it has one"""
+    if not get_history_ttl():
+        return
+    key = get_history_key(thread_id)
+    pipeline = app.redis.pipeline(transaction=False)
+    pipeline.rpushx(key, entry)
+    pipeline.expire(key, get_history_ttl())
+    pipeline.execute()
+
+
+def forget_history(thread_id: UUID):
+    """drop the history list of a thread"""
+    app.redis.delete(get_history_key(thread_id))
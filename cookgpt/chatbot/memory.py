@@ -7,23 +7,41 @@ SqlConversationMemory:
     the assistant in an SQL database augmented with Flask-SqlAlchemy
 """
 import datetime
-from typing import Any, Dict, Iterable, cast
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence
+from uuid import UUID
 
 from langchain.memory import ConversationBufferMemory
 from langchain.memory.chat_message_histories.in_memory import (
     ChatMessageHistory,
 )
+from langchain.memory.summary import SummarizerMixin
 from langchain.schema import (
     AIMessage,
     BaseMessage,
     HumanMessage,
+    SystemMessage,
     get_buffer_string,
 )
-from pydantic import BaseModel, Field, root_validator
+from langchain.schema.language_model import BaseLanguageModel
+from pydantic import BaseModel, Field, PrivateAttr, root_validator
+from sqlalchemy import Row, select
 
 from cookgpt import logging
-from cookgpt.chatbot.models import Chat, MessageType
+from cookgpt.chatbot.history import (
+    append_history,
+    dump_entry,
+    get_cached_tokens,
+    get_summary_id,
+    load_history,
+    store_history,
+)
+from cookgpt.chatbot.models import Chat, MessageType, Thread
+from cookgpt.chatbot.utils import (
+    convert_message_to_dict,
+    count_message_tokens,
+)
 from cookgpt.ext.config import config
+from cookgpt.ext.database import db
 from cookgpt.globals import (
     chat_cost,
     getvar,
@@ -35,6 +53,9 @@ from cookgpt.globals import (
     user,
 )
 
+if TYPE_CHECKING:
+    from cookgpt.chatbot.history import HistoryEntry
+
 
 def get_memory_key() -> str:
     """get chat memory key"""
@@ -56,8 +77,39 @@ def get_memory_input_key() -> str:
     return config["CHATBOT_CHAIN_INPUT_KEY"]
 
 
+def get_memory_max_tokens() -> int:
+    """get the token budget of the window memory"""
+    return config["CHATBOT_MEMORY_MAX_TOKENS"]
+
+
+def get_memory_recent_turns() -> int:
+    """get the number of turns the summary memory keeps as they are"""
+    return config["CHATBOT_MEMORY_RECENT_TURNS"]
+
+
+def get_summary_llm() -> BaseLanguageModel:
+    """get the language model used to summarize threads"""
+    from cookgpt.chatbot.chain import get_llm
+
+    return get_llm(streaming=False)
+
+
+def make_message(id: "UUID | str", content: str, chat_type: MessageType):
+    """make a langchain message from the columns of a chat"""
+    msg_cls = HumanMessage if chat_type == MessageType.QUERY else AIMessage
+    return msg_cls(content=content, additional_kwargs={"id": str(id)})
+
+
 class SingleThreadHistory(ChatMessageHistory, BaseModel):
-    """An SqlAlchemy models backed chat history"""
+    """
+    An SqlAlchemy models backed chat history
+
+    The messages of the thread are loaded into a snapshot the first time
+    they are accessed, messages added afterwards are appended to it.
+    """
+
+    # the id of the thread the snapshot was taken from
+    _snapshot_of: Optional[UUID] = PrivateAttr(default=None)
 
     @property
     def query_cost(self) -> int:
@@ -71,28 +123,80 @@ class SingleThreadHistory(ChatMessageHistory, BaseModel):
 
     def __getattribute__(self, __name: str) -> Any:
         if __name == "messages":
-            setattr(self, __name, self.get_messages())
+            self.load_messages()
         return super().__getattribute__(__name)
 
-    def get_messages(self) -> "list[BaseMessage]":  # pragma: no cover
+    def load_messages(self, reload=False):
+        """take a snapshot of the messages in the thread"""
+        if reload or self._snapshot_of != thread.id:
+            self.messages = self.get_messages()
+            self._snapshot_of = thread.id
+
+    def add_to_snapshot(self, message: "BaseMessage"):
+        """add a message to the snapshot if it has been taken"""
+        if self._snapshot_of == thread.id:
+            self.messages.append(message)
+
+    def get_messages(self) -> "list[BaseMessage]":
         """get all messages in thread"""
-        chats: "list[BaseMessage]" = []
-        # non-empty chats
-        chats_query = Chat.query.filter(
-            Chat.thread_id == thread.id, Chat.content != ""
-        )
-        for chat in cast(Iterable[Chat], chats_query):
-            msg_cls = (
-                HumanMessage
-                if chat.chat_type == MessageType.QUERY
-                else AIMessage
+        entries = load_history(thread.id)
+        if entries is None:
+            entries = self.get_history_entries()
+        return [
+            make_message(id, content, chat_type)
+            for id, chat_type, content, _ in entries
+        ]
+
+    def select_chats(
+        self,
+    ) -> "Sequence[Row[tuple[UUID, str, MessageType, Optional[int]]]]":
+        """
+        select the id, content, type and tokens of the non-empty chats in
+        the thread, without loading them as models
+        """
+        return db.session.execute(
+            select(Chat.id, Chat.content, Chat.chat_type, Chat.content_tokens)
+            .where(Chat.thread_id == thread.id, Chat.content != "")
+            .order_by(Chat.order)
+        ).all()
+
+    def get_history_entries(self) -> "list[HistoryEntry]":
+        """load the messages in the thread and cache them in redis"""
+        rows = self.select_chats()
+        # chats that were not counted when they were written
+        uncounted = [row.id for row in rows if row.content_tokens is None]
+        cached = dict(zip(uncounted, get_cached_tokens(uncounted)))
+        entries: "list[HistoryEntry]" = [
+            (
+                str(id),
+                chat_type,
+                content,
+                tokens if tokens is not None else cached[id],
             )
-            chats.append(
-                msg_cls(
-                    content=chat.content, additional_kwargs={"id": chat.pk}
-                )
-            )
-        return chats
+            for id, content, chat_type, tokens in rows
+        ]
+        store_history(thread.id, [dump_entry(*entry) for entry in entries])
+        return entries
+
+    def count_tokens(self, message: "BaseMessage") -> int:
+        """
+        count the tokens of a message, usually cached when it was sent
+        to the AI
+        """
+        (tokens,) = count_message_tokens(
+            [convert_message_to_dict(message)]
+        ).costs
+        return tokens
+
+    def save_to_history(self, chat: "Chat", message: "BaseMessage"):
+        """add a saved message to the snapshot and the redis history"""
+        self.add_to_snapshot(message)
+        append_history(
+            thread.id,
+            dump_entry(
+                chat.id, chat.chat_type, chat.content, chat.content_tokens
+            ),
+        )
 
     def add_user_message(self, message: str) -> None:
         """add the user's query to the database"""
@@ -105,7 +209,12 @@ class SingleThreadHistory(ChatMessageHistory, BaseModel):
             "The query being added to the thread does not "
             "belong to the thread."
         )
+        msg = HumanMessage(
+            content=message, additional_kwargs={"id": query.sid}
+        )
+        extra["content_tokens"] = self.count_tokens(msg)
         query.update(content=message, **extra)
+        self.save_to_history(query, msg)
         return None
 
     def add_ai_message(self, message: str) -> None:
@@ -120,11 +229,174 @@ class SingleThreadHistory(ChatMessageHistory, BaseModel):
             "The response being added to the thread does not "
             "belong to the thread."
         )
+        msg = AIMessage(
+            content=message, additional_kwargs={"id": response.sid}
+        )
+        extra["content_tokens"] = self.count_tokens(msg)
         response.update(content=message, **extra)
+        self.save_to_history(response, msg)
 
     def clear(self) -> None:  # pragma: no cover
         """Clear all messages in the thread"""
-        return thread.clear()
+        thread.clear()
+        self.messages = []
+        self._snapshot_of = thread.id
+
+
+class WindowThreadHistory(SingleThreadHistory):
+    """
+    A chat history with the most recent messages of a thread that fit
+    into a token budget
+    """
+
+    max_tokens: int = Field(default_factory=get_memory_max_tokens)
+    page_size: int = 20
+
+    def get_message_costs(self, messages: "list[BaseMessage]") -> "list[int]":
+        """
+        get the cost of each message, using the costs cached when the
+        messages were first sent
+        """
+        return count_message_tokens(
+            [convert_message_to_dict(m) for m in messages]
+        ).costs
+
+    def get_page_costs(
+        self, rows: "Sequence[Row]", page: "list[BaseMessage]"
+    ) -> "list[int]":
+        """
+        get the cost of each message in a page, counting the chats that
+        were not counted when they were written
+        """
+        uncounted = [
+            i for i, row in enumerate(rows) if row.content_tokens is None
+        ]
+        costs = [row.content_tokens for row in rows]
+        counted = self.get_message_costs([page[i] for i in uncounted])
+        for i, cost in zip(uncounted, counted):
+            costs[i] = cost
+        return costs
+
+    def get_messages(self) -> "list[BaseMessage]":
+        """get the most recent messages in the thread within the budget"""
+        chats: "list[BaseMessage]" = []
+        budget = self.max_tokens
+        before = None
+        while True:
+            # walk back through the thread one page at a time
+            page_query = (
+                select(
+                    Chat.id,
+                    Chat.content,
+                    Chat.chat_type,
+                    Chat.order,
+                    Chat.content_tokens,
+                )
+                .where(Chat.thread_id == thread.id, Chat.content != "")
+                .order_by(Chat.order.desc())
+                .limit(self.page_size)
+            )
+            if before is not None:
+                page_query = page_query.where(Chat.order < before)
+            rows = db.session.execute(page_query).all()
+            page = [make_message(*row[:3]) for row in rows]
+            for message, cost in zip(page, self.get_page_costs(rows, page)):
+                budget -= cost
+                if budget < 0:
+                    chats.reverse()
+                    return chats
+                chats.append(message)
+            if len(rows) < self.page_size:
+                break
+            before = rows[-1].order
+        chats.reverse()
+        return chats
+
+
+class SummaryThreadHistory(SingleThreadHistory):
+    """
+    A chat history with the rolling summary of a thread followed by its
+    most recent turns
+    """
+
+    recent_turns: int = Field(default_factory=get_memory_recent_turns)
+
+    def get_messages(self) -> "list[BaseMessage]":
+        """get the summary and the recent messages in the thread"""
+        rows = db.session.execute(
+            select(Chat.id, Chat.content, Chat.chat_type)
+            .where(
+                Chat.thread_id == thread.id,
+                Chat.content != "",
+                Chat.order > thread.summary_order,
+            )
+            .order_by(Chat.order.desc())
+            .limit(self.recent_turns * 2)
+        ).all()
+        chats: "list[BaseMessage]" = [make_message(*row) for row in rows]
+        chats.reverse()
+        if thread.summary:
+            # the id makes the cost of each summary cached separately
+            summary_id = get_summary_id(thread.id, thread.summary_order)
+            chats.insert(
+                0,
+                SystemMessage(
+                    content=f"Summary of the earlier conversation:\n"
+                    f"{thread.summary}",
+                    additional_kwargs={"id": summary_id},
+                ),
+            )
+        return chats
+
+
+class ThreadSummarizer(SummarizerMixin):
+    """Condenses the older turns of a thread into its rolling summary"""
+
+    human_prefix: str = Field(default_factory=get_human_prefix)
+    ai_prefix: str = Field(default_factory=get_ai_prefix)
+    llm: BaseLanguageModel = Field(default_factory=get_summary_llm)
+    recent_turns: int = Field(default_factory=get_memory_recent_turns)
+    # the most messages that are added to the summary at once
+    batch_size: int = 20
+
+    def summarize(self, thread: "Thread") -> bool:
+        """
+        Add the messages that are no longer among the recent turns to the
+        thread's summary.
+
+        At most `batch_size` messages are summarized per call, a backlog
+        is worked off by the following calls.
+        Returns whether the summary was updated.
+        """
+        non_empty = (Chat.thread_id == thread.id) & (Chat.content != "")
+        # order of the oldest message that is still a recent turn
+        oldest_recent = (
+            select(Chat.order)
+            .where(non_empty)
+            .order_by(Chat.order.desc())
+            .offset(self.recent_turns * 2 - 1)
+            .limit(1)
+            .scalar_subquery()
+        )
+        rows = db.session.execute(
+            select(Chat.id, Chat.content, Chat.chat_type, Chat.order)
+            .where(
+                non_empty,
+                Chat.order > thread.summary_order,
+                Chat.order < oldest_recent,
+            )
+            .order_by(Chat.order)
+            .limit(self.batch_size)
+        ).all()
+        if not rows:
+            return False
+        logging.debug(
+            "Summarizing %d messages of thread %s", len(rows), thread.id
+        )
+        summary = self.predict_new_summary(
+            [make_message(*row[:3]) for row in rows], thread.summary
+        )
+        return thread.set_summary(summary, rows[-1].order)
 
 
 class BaseMemory(ConversationBufferMemory):
@@ -176,6 +448,11 @@ class ThreadMemory(BaseMemory, BaseModel):
     )
     return_message: bool = False
 
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """load the thread once for every generation"""
+        self.chat_memory.load_messages(reload=True)
+        return super().load_memory_variables(inputs)
+
     def save_context(
         self, inputs: Dict[str, Any], outputs: Dict[str, str]
     ) -> None:
@@ -188,3 +465,38 @@ class ThreadMemory(BaseMemory, BaseModel):
         inputs[self.input_key] = input
         super().save_context(inputs, outputs)
         resetvar("chat_cost")
+
+
+class WindowThreadMemory(ThreadMemory):
+    """
+    A conversation thread memory that only remembers the most recent
+    messages that fit into `CHATBOT_MEMORY_MAX_TOKENS`
+    """
+
+    chat_memory: "WindowThreadHistory" = Field(
+        default_factory=WindowThreadHistory
+    )
+
+
+class SummaryThreadMemory(ThreadMemory):
+    """
+    A conversation thread memory that remembers a rolling summary of the
+    thread and its `CHATBOT_MEMORY_RECENT_TURNS` most recent turns
+    """
+
+    chat_memory: "SummaryThreadHistory" = Field(
+        default_factory=SummaryThreadHistory
+    )
+
+
+def get_memory() -> "BaseMemory":
+    """get the memory selected by `CHATBOT_MEMORY_TYPE`"""
+    memory_types: "dict[str, type[BaseMemory]]" = {
+        "thread": ThreadMemory,
+        "window": WindowThreadMemory,
+        "summary": SummaryThreadMemory,
+    }
+    memory_type = config["CHATBOT_MEMORY_TYPE"]
+    if memory_type not in memory_types:  # pragma: no cover
+        raise ValueError(f"Unknown memory type {memory_type!r}")
+    return memory_types[memory_type]()
@@ -1,12 +1,24 @@
 """Chatbot models."""
+import json
+import zlib
 from datetime import datetime
 from typing import TYPE_CHECKING, List, Optional, Sequence, cast
 from uuid import UUID, uuid4
 
-from sqlalchemy import Enum, ForeignKey, Text
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import (
+    Enum,
+    ForeignKey,
+    Text,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.orm import Mapped, column_property, mapped_column
 
 from cookgpt import logging
+from cookgpt.chatbot.history import forget_history, forget_summary_cost
 from cookgpt.ext import cache, db
 from cookgpt.ext.cache import (
     chat_cache_key,
@@ -30,6 +42,8 @@ class Chat(db.Model):  # type: ignore
     id: Mapped[UUID] = mapped_column(primary_key=True, default=uuid4)
     content: Mapped[str] = mapped_column(Text)
     cost: Mapped[int] = mapped_column(default=0)
+    # the tokens of the content as a prompt message, NULL until counted
+    content_tokens: Mapped[Optional[int]] = mapped_column(default=None)
     chat_type: Mapped[MessageType] = mapped_column(Enum(MessageType))
     thread_id: Mapped[UUID] = mapped_column(db.ForeignKey("thread.id"))
     previous_chat_id: Mapped[Optional[UUID]] = mapped_column(
@@ -53,10 +67,24 @@ class Chat(db.Model):  # type: ignore
         foreign_keys=[thread_id],
     )
 
+    if TYPE_CHECKING:
+        # mapped below the class as a correlated subquery
+        next_chat_id: Optional[UUID]
+
     __table_args__ = (
         db.UniqueConstraint(
             "thread_id", "order", name="unique_order_per_thread"
         ),
+        # covers aggregating and range-deleting a thread's chats
+        db.Index(
+            "ix_chat_thread_id_order_cost_tokens",
+            "thread_id",
+            "order",
+            "cost",
+            "content_tokens",
+        ),
+        # used to find the next chat in the linked list
+        db.Index("ix_chat_previous_chat_id", "previous_chat_id"),
     )
 
     def __repr__(self):
@@ -70,42 +98,54 @@ class Chat(db.Model):  # type: ignore
             self.next_chat_id.hex[:6] if self.next_chat_id else "none",
         )
 
-    @property
-    def next_chat_id(self) -> "UUID | None":
-        """get the next chat's id"""
-        if self.next_chat:
-            return self.next_chat.id
-        return None
-
     @classmethod
     def create(self, commit=True, **attrs):
         """Create the chat"""
-        chat = super().create(commit, **attrs)
+        chat = super().create(False, **attrs)
+        db.session.add(chat)
+        thread = chat.thread or db.session.get(Thread, chat.thread_id)
+        if thread is not None:
+            thread.chat_added(chat)
         if commit:
-            cache.delete(chats_cache_key(thread_id=chat.thread.pk))
-            cache.delete(thread_cache_key(thread_id=chat.thread.pk))
-            cache.delete(threads_cache_key(user_id=chat.thread.user.pk))
+            db.session.commit()
+            cache.delete_many(
+                chats_cache_key(thread_id=chat.thread.pk),
+                thread_cache_key(thread_id=chat.thread.pk),
+                threads_cache_key(user_id=chat.thread.user.pk),
+            )
         return chat
 
     def update(self, commit=True, **attrs):
         """Update the chat"""
+        cost_changed = "cost" in attrs and attrs["cost"] != self.cost
+        if cost_changed:
+            self.thread.adjust_aggregates(cost=attrs["cost"] - self.cost)
         super().update(commit, **attrs)
         if commit:
-            cache.delete(chat_cache_key(chat_id=self.pk))
-            cache.delete(chats_cache_key(thread_id=self.thread.pk))
+            keys = [
+                chat_cache_key(chat_id=self.pk),
+                chats_cache_key(thread_id=self.thread.pk),
+            ]
+            if cost_changed:
+                keys.append(thread_cache_key(thread_id=self.thread.pk))
+                keys.append(threads_cache_key(user_id=self.thread.user.pk))
+            cache.delete_many(*keys)
         return self
 
     def delete(self, commit=True):
-        """Delete the chat"""
-        super().delete(commit)
-        if commit:
-            cache.delete(chat_cache_key(chat_id=self.pk))
-            cache.delete(chats_cache_key(thread_id=self.thread.pk))
-            cache.delete(thread_cache_key(thread_id=self.thread.pk))
-            cache.delete(threads_cache_key(user_id=self.thread.user.pk))
-            # Delete the previous chat's cache
-            if self.previous_chat:  # pragma: no cover
-                cache.delete(chat_cache_key(chat_id=self.previous_chat.pk))
+        """Delete the chat and the chats that follow it"""
+        self.thread.delete_chats(self.order, commit)
+
+
+# the next chat's id is loaded in the same query as the chat, using the
+# `previous_chat_id` index, instead of lazy-loading `Chat.next_chat`
+_next_chat = Chat.__table__.alias("next_chat")
+Chat.next_chat_id = column_property(
+    select(_next_chat.c.id)
+    .where(_next_chat.c.previous_chat_id == Chat.__table__.c.id)
+    .limit(1)
+    .scalar_subquery()
+)
 
 
 class Thread(db.Model):  # type: ignore
@@ -127,34 +167,151 @@ class Thread(db.Model):  # type: ignore
         foreign_keys=[user_id],
     )
     closed: Mapped[bool] = mapped_column(default=False)
+    # denormalized aggregates of the thread's chats, kept in sync by
+    # `Chat.create`, `Chat.update` and `Chat.delete`
+    cost_total: Mapped[int] = mapped_column(default=0)
+    chat_count: Mapped[int] = mapped_column(default=0)
+    # id of the chat with the highest order. This is not a foreign key
+    # so that thread and chat don't depend on each other.
+    last_chat_id: Mapped[Optional[UUID]] = mapped_column(default=None)
+
+    # rolling summary of the chats up to and including `summary_order`,
+    # used by the summary memory
+    summary: Mapped[str] = mapped_column(Text, default="")
+    summary_order: Mapped[int] = mapped_column(default=-1)
+
+    # the chats of archived threads live in `archived_chats`
+    archived: Mapped[bool] = mapped_column(default=False)
+    archived_chats: Mapped[
+        Optional["ThreadArchive"]
+    ] = db.relationship(  # type: ignore[assignment]
+        back_populates="thread",
+        cascade="all, delete-orphan",
+        uselist=False,
+    )
+
+    __table_args__ = (
+        # used to list a user's active threads
+        db.Index("ix_thread_user_id_closed", "user_id", "closed"),
+    )
 
     def __repr__(self):
-        num_chats = len(self.chats)  # type: ignore
         return "Thread[{}](user={}, chats={}, closed={})".format(
             self.id.hex[:6],
             self.user.name,
-            num_chats,
+            self.chat_count,
             "✔" if self.closed else "✗",
         )
 
     @property
     def cost(self) -> int:
         """total cost of all messages"""
-        return sum(chat.cost for chat in self.chats)  # type: ignore
+        return self.cost_total
+
+    def adjust_aggregates(self, cost: int = 0, count: int = 0, **values):
+        """
+        Atomically adjust the denormalized aggregates of the thread.
+
+        The update is executed in the current transaction; `cost` and
+        `count` are added to the stored values while any other `values`
+        (e.g `last_chat_id`) are set as they are.
+        """
+        values.update(
+            cost_total=Thread.cost_total + cost,
+            chat_count=Thread.chat_count + count,
+        )
+        db.session.execute(
+            update(Thread).where(Thread.id == self.id).values(**values)
+        )
 
-    @property
-    def chat_count(self) -> int:
-        """number of messages in the thread"""
-        return len(self.chats)  # type: ignore
+    def chat_added(self, chat: "Chat"):
+        """update the thread's aggregates after a chat is added"""
+        db.session.flush([chat])  # assigns the chat's id and defaults
+        values = {}
+        tail = self.last_chat
+        if tail is None or chat.order > tail.order:
+            values["last_chat_id"] = chat.id
+        self.adjust_aggregates(cost=chat.cost, count=1, **values)
+        if chat.content:
+            forget_history(self.id)
+
+    @classmethod
+    def reconcile(cls, thread_ids: "Sequence[UUID] | None" = None) -> int:
+        """
+        Recompute the denormalized aggregates of threads from their chats.
+
+        If `thread_ids` is not given, every thread is reconciled.
+        Returns the number of threads updated.
+        """
+        cost = (
+            select(func.coalesce(func.sum(Chat.cost), 0))
+            .where(Chat.thread_id == Thread.id)
+            .scalar_subquery()
+        )
+        count = (
+            select(func.count(Chat.id))
+            .where(Chat.thread_id == Thread.id)
+            .scalar_subquery()
+        )
+        last_chat_id = (
+            select(Chat.id)
+            .where(Chat.thread_id == Thread.id)
+            .order_by(Chat.order.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        stmt = update(Thread).values(
+            cost_total=cost, chat_count=count, last_chat_id=last_chat_id
+        )
+        if thread_ids is not None:
+            stmt = stmt.where(Thread.id.in_(thread_ids))
+        result = db.session.execute(
+            stmt, execution_options={"synchronize_session": "fetch"}
+        )
+        return result.rowcount
 
     @property
-    def last_chat(self) -> "Chat":
+    def last_chat(self) -> "Chat | None":
         """get the last chat in the thread"""
-        return (
-            Chat.query.filter(Chat.thread_id == self.id, ~Chat.next_chat.has())
-            .order_by(Chat.order.desc())
-            .first()
-        )  # type: ignore
+        if self.last_chat_id is None:
+            return None
+        return db.session.get(Chat, self.last_chat_id)
+
+    def get_chats(
+        self,
+        limit: int,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+    ) -> "tuple[list[Chat], Optional[int]]":
+        """
+        Get a page of chats using the `(thread_id, order)` index.
+
+        Without a cursor, the most recent chats are returned. `before` and
+        `after` return the chats preceding and following that order.
+        The chats are always sorted by `order`, and the returned cursor
+        (None on the last page) continues in the same direction.
+        """
+        query = Chat.query.filter(Chat.thread_id == self.id)
+        if after is not None:
+            chats = cast(
+                "list[Chat]",
+                query.filter(Chat.order > after)
+                .order_by(Chat.order.asc())
+                .limit(limit + 1)
+                .all(),
+            )
+            has_more = len(chats) > limit
+            chats = chats[:limit]
+            return chats, chats[-1].order if has_more else None
+        if before is not None:
+            query = query.filter(Chat.order < before)
+        chats = cast(
+            "list[Chat]",
+            query.order_by(Chat.order.desc()).limit(limit + 1).all(),
+        )
+        has_more = len(chats) > limit
+        chats = chats[:limit][::-1]
+        return chats, chats[0].order if has_more else None
 
     def add_chat(
         self,
@@ -220,23 +377,269 @@ class Thread(db.Model):  # type: ignore
             content, MessageType.RESPONSE, cost, previous_chat, commit, **attrs
         )
 
+    def add_exchange(
+        self,
+        query: str = "",
+        response: str = "",
+        query_cost: int = 0,
+        response_cost: int = 0,
+        commit=True,
+    ) -> "tuple[Chat, Chat]":
+        """
+        Add a query and its response to the end of the thread.
+
+        Both chats, their links and the thread's aggregates are written in
+        one transaction and the caches are invalidated in one round trip.
+        """
+        logging.debug(
+            "adding exchange to thread %s: %s", self.id.hex[:6], query[:20]
+        )
+        previous_chat = self.last_chat
+        order = previous_chat.order + 1 if previous_chat else 0
+        query_chat = Chat(
+            id=uuid4(),
+            content=query,
+            chat_type=MessageType.QUERY,
+            cost=query_cost,
+            thread_id=self.id,
+            previous_chat_id=previous_chat.id if previous_chat else None,
+            order=order,
+        )
+        response_chat = Chat(
+            id=uuid4(),
+            content=response,
+            chat_type=MessageType.RESPONSE,
+            cost=response_cost,
+            thread_id=self.id,
+            previous_chat_id=query_chat.id,
+            order=order + 1,
+        )
+        db.session.add_all([query_chat, response_chat])
+        if query or response:
+            forget_history(self.id)
+        self.adjust_aggregates(
+            cost=query_cost + response_cost,
+            count=2,
+            last_chat_id=response_chat.id,
+        )
+        if commit:
+            # read before committing, the thread is expired afterwards
+            keys = (
+                chats_cache_key(thread_id=self.id),
+                thread_cache_key(thread_id=self.id),
+                threads_cache_key(user_id=self.user_id),
+            )
+            db.session.commit()
+            cache.delete_many(*keys)
+        return query_chat, response_chat
+
     def close(self):
         """Close the thread"""
         logging.debug("closing thread %s", self.id.hex[:6])
         self.update(closed=True)
 
+    def delete_chats(self, start: int = 0, commit=True) -> int:
+        """
+        Delete the chats in the thread from order `start` onwards.
+
+        This uses set-based statements instead of the ORM cascade, so the
+        number of round trips does not depend on how many chats are
+        deleted. Returns the number of chats deleted.
+        """
+        from cookgpt.chatbot.quota import forget_used_tokens
+
+        if self.archived:
+            if start == 0:
+                return self._delete_archived_chats(commit)
+            # the chats before `start` are kept, so they are moved back
+            self.restore(commit=False)
+        condition = (Chat.thread_id == self.id) & (Chat.order >= start)
+        chats = db.session.execute(select(Chat.id, Chat.cost).where(condition))
+        chat_ids, costs = cast(
+            "tuple[tuple[UUID, ...], tuple[int, ...]]",
+            tuple(zip(*chats)) or ((), ()),
+        )
+        if not chat_ids:
+            return 0
+        tail_id = None
+        if start > 0:
+            tail_id = db.session.scalar(
+                select(Chat.id)
+                .where(Chat.thread_id == self.id, Chat.order < start)
+                .order_by(Chat.order.desc())
+                .limit(1)
+            )
+        values = {}
+        if start <= self.summary_order:
+            # the summary describes chats that no longer exist
+            forget_summary_cost(self.id, self.summary_order)
+            values.update(summary="", summary_order=-1)
+        self._delete_chat_rows(condition)
+        self.adjust_aggregates(
+            cost=-sum(costs),
+            count=-len(chat_ids),
+            last_chat_id=tail_id,
+            **values,
+        )
+        db.session.expire(self, ["chats"])
+        if commit:
+            keys = [
+                chats_cache_key(thread_id=self.id),
+                thread_cache_key(thread_id=self.id),
+                threads_cache_key(user_id=self.user_id),
+                *(chat_cache_key(chat_id=chat_id) for chat_id in chat_ids),
+            ]
+            if tail_id is not None:
+                keys.append(chat_cache_key(chat_id=tail_id))
+            db.session.commit()
+            cache.delete_many(*keys)
+        # the deleted tokens are no longer counted towards the quota
+        forget_used_tokens(self.user_id)
+        forget_history(self.id)
+        return len(chat_ids)
+
+    def _delete_archived_chats(self, commit=True) -> int:
+        """
+        Delete every chat of an archived thread by dropping its archive.
+
+        Returns the number of chats deleted.
+        """
+        from cookgpt.chatbot.quota import forget_used_tokens
+
+        count, summary_order = self.chat_count, self.summary_order
+        # claim the archive like `restore` does, a thread restored by a
+        # concurrent request has its chats in the chat table again
+        claimed = db.session.execute(
+            update(Thread)
+            .where(Thread.id == self.id, Thread.archived == True)  # noqa: E712
+            .values(
+                archived=False,
+                cost_total=0,
+                chat_count=0,
+                last_chat_id=None,
+                summary="",
+                summary_order=-1,
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.expire(self)
+        if not claimed:
+            return self.delete_chats(commit=commit)
+        logging.debug("dropping the archive of thread %s", self.id.hex[:6])
+        db.session.execute(
+            delete(ThreadArchive).where(ThreadArchive.thread_id == self.id)
+        )
+        forget_summary_cost(self.id, summary_order)
+        if commit:
+            keys = (
+                chats_cache_key(thread_id=self.id),
+                thread_cache_key(thread_id=self.id),
+                threads_cache_key(user_id=self.user_id),
+            )
+            db.session.commit()
+            cache.delete_many(*keys)
+        forget_used_tokens(self.user_id)
+        forget_history(self.id)
+        return count
+
+    def set_summary(self, summary: str, order: int, commit=True) -> bool:
+        """
+        Replace the rolling summary with one that covers the chats up to
+        `order`.
+
+        The summary is only replaced if it doesn't already cover those
+        chats, so concurrent summarizations can't overwrite each other.
+        Returns whether the summary was replaced.
+        """
+        previous_order = self.summary_order
+        result = db.session.execute(
+            update(Thread)
+            .where(Thread.id == self.id, Thread.summary_order < order)
+            .values(summary=summary, summary_order=order)
+        )
+        if commit:
+            db.session.commit()
+        if result.rowcount:
+            forget_summary_cost(self.id, previous_order)
+        return bool(result.rowcount)
+
+    def _delete_chat_rows(self, condition):
+        """delete the chat rows matching `condition`"""
+        # unlink the chats first so the self-referential foreign key
+        # doesn't depend on the order in which rows are deleted
+        db.session.execute(
+            update(Chat).where(condition).values(previous_chat_id=None)
+        )
+        db.session.execute(delete(Chat).where(condition))
+
+    def archive(self, commit=True) -> int:
+        """
+        Move the thread's chats into a compressed archive.
+
+        The thread's aggregates are left as they are because the chats
+        still belong to it; they are moved back by `restore`.
+        Returns the number of chats archived.
+        """
+        if self.archived:
+            return 0
+        logging.debug("archiving thread %s", self.id.hex[:6])
+        condition = Chat.thread_id == self.id
+        rows = db.session.execute(
+            select(*ThreadArchive.columns()).where(condition)
+        ).all()
+        self.archived_chats = ThreadArchive.pack(rows)
+        self._delete_chat_rows(condition)
+        self.archived = True
+        forget_history(self.id)
+        forget_summary_cost(self.id, self.summary_order)
+        db.session.expire(self, ["chats"])
+        if commit:
+            db.session.commit()
+        return len(rows)
+
+    def restore(self, commit=True) -> int:
+        """
+        Move the chats of an archived thread back into the chat table.
+
+        Returns the number of chats restored.
+        """
+        if not self.archived:
+            return 0
+        # claim the restore before moving the chats. A concurrent request
+        # that also saw the thread archived waits for the row and finds it
+        # claimed, instead of inserting the same chats again
+        claimed = db.session.execute(
+            update(Thread)
+            .where(Thread.id == self.id, Thread.archived == True)  # noqa: E712
+            .values(archived=False)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            logging.debug("thread %s was restored already", self.id.hex[:6])
+            db.session.expire(self, ["archived", "archived_chats", "chats"])
+            return 0
+        logging.debug("restoring thread %s", self.id.hex[:6])
+        rows = self.archived_chats.unpack() if self.archived_chats else []
+        if rows:
+            db.session.execute(
+                insert(Chat), [{**row, "thread_id": self.id} for row in rows]
+            )
+        self.archived_chats = None
+        self.archived = False
+        forget_history(self.id)
+        db.session.expire(self, ["chats"])
+        if commit:
+            db.session.commit()
+        return len(rows)
+
     def clear(self):
         """Clear all messages in the thread"""
         logging.debug(
             "clearing %d chats from thread %s",
-            len(self.chats),
+            self.chat_count,
             self.id.hex[:6],
         )
-        for chat in Chat.query.filter(
-            Chat.thread_id == self.id,
-            Chat.previous_chat_id == None,  # noqa: E711
-        ).all():
-            cast(Chat, chat).delete()
+        self.delete_chats()
 
     @classmethod
     def create(self, commit=True, **attrs):
@@ -256,10 +659,91 @@ class Thread(db.Model):  # type: ignore
 
     def delete(self, commit=True):
         """Delete the thread"""
+        from cookgpt.chatbot.quota import forget_used_tokens
+
+        user_id = self.user_id
+        self.delete_chats(commit=False)
         super().delete(commit)
         if commit:
             cache.delete(thread_cache_key(thread_id=self.pk))
             cache.delete(threads_cache_key(user_id=self.user.pk))
+        # forgotten again once the thread is gone, a reservation made
+        # before the commit may have re-seeded the ledger with its cost
+        forget_used_tokens(user_id)
+        forget_history(self.id)
+
+
+class ThreadArchive(db.Model):  # type: ignore
+    """The compressed chats of an archived thread"""
+
+    # columns of the chat table that are stored in an archive
+    COLUMNS = (
+        "id",
+        "content",
+        "cost",
+        "chat_type",
+        "previous_chat_id",
+        "sent_time",
+        "order",
+        "created_at",
+        "updated_at",
+        "content_tokens",
+    )
+    # 2: added content_tokens, it is missing from the rows of version 1
+    VERSION = 2
+
+    thread_id: Mapped[UUID] = mapped_column(
+        ForeignKey("thread.id"), unique=True
+    )
+    thread: Mapped["Thread"] = db.relationship(  # type: ignore[assignment]
+        back_populates="archived_chats",
+        foreign_keys=[thread_id],
+    )
+    chat_count: Mapped[int] = mapped_column(default=0)
+    version: Mapped[int] = mapped_column(default=VERSION)
+    # zlib compressed json array of chat rows
+    data: Mapped[bytes] = mapped_column(db.LargeBinary(2**32 - 1))
+
+    @classmethod
+    def columns(cls):
+        """the chat columns stored in an archive"""
+        return [getattr(Chat, column) for column in cls.COLUMNS]
+
+    @classmethod
+    def pack(cls, rows: "Sequence[Sequence]") -> "ThreadArchive":
+        """create an archive from chat rows selected using `columns`"""
+
+        def encode(value):
+            if isinstance(value, UUID):
+                return value.hex
+            if isinstance(value, MessageType):
+                return value.name
+            if isinstance(value, datetime):
+                return value.isoformat()
+            return value
+
+        data = [[encode(value) for value in row] for row in rows]
+        return cls(
+            chat_count=len(data),
+            version=cls.VERSION,
+            data=zlib.compress(
+                json.dumps(data, separators=(",", ":")).encode()
+            ),
+        )
+
+    def unpack(self) -> "list[dict]":
+        """decompress the archive into chat rows"""
+        rows: "list[dict]" = []
+        for values in json.loads(zlib.decompress(self.data)):
+            row = dict(zip(self.COLUMNS, values))
+            row["id"] = UUID(row["id"])
+            if row["previous_chat_id"]:
+                row["previous_chat_id"] = UUID(row["previous_chat_id"])
+            row["chat_type"] = MessageType[row["chat_type"]]
+            for key in ("sent_time", "created_at", "updated_at"):
+                row[key] = datetime.fromisoformat(row[key])
+            rows.append(row)
+        return rows
 
 
 class ThreadMixin:
@@ -375,3 +859,25 @@ class ThreadMixin:
         return Thread.query.filter(
             Thread.user_id == self.id, Thread.closed == False  # noqa: E712
         ).all()
+
+    def get_thread_summaries(self) -> "list[dict]":
+        """
+        Get the id, title, chat count and cost of all active threads.
+
+        Only the columns that are listed are selected, so no Thread or
+        Chat objects are loaded.
+        """
+        return [
+            dict(row)
+            for row in db.session.execute(
+                select(
+                    Thread.id,
+                    Thread.title,
+                    Thread.chat_count,
+                    Thread.cost_total.label("cost"),
+                ).where(
+                    Thread.user_id == self.id,
+                    Thread.closed == False,  # noqa: E712
+                )
+            ).mappings()
+        ]
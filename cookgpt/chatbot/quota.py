@@ -0,0 +1,192 @@
+"""
+A per-user token quota ledger kept in redis.
+
+Each user has a hash at `quota:<user id>` with the fields:
+
+used:
+    the tokens spent by the user, seeded from the database
+reserved:
+    the total of the outstanding reservations
+r:<reservation id>:
+    the tokens held by a single reservation
+
+Reservations are taken before a query is sent to the AI and settled
+with the real cost when the task completes. Both run as lua scripts, so
+the check and the update happen atomically in a single round trip.
+"""
+from typing import TYPE_CHECKING
+from uuid import UUID, uuid4
+
+from sqlalchemy import func, select
+
+from cookgpt import logging
+from cookgpt.chatbot.models import Chat, Thread
+from cookgpt.chatbot.history import get_history_key
+from cookgpt.chatbot.utils import (
+    count_tokens,
+    get_encoding,
+    get_system_prompt_tokens,
+)
+from cookgpt.ext.config import config
+from cookgpt.ext.database import db
+from cookgpt.globals import current_app as app
+
+if TYPE_CHECKING:
+    from cookgpt.auth.models import User
+
+# returns 1 if the tokens were reserved, 0 if the reservation would take
+# the user over their quota and -1 if the ledger has not been seeded
+RESERVE_SCRIPT = """
+local used = redis.call('HGET', KEYS[1], 'used')
+if not used then
+    return -1
+end
+local reserved = tonumber(redis.call('HGET', KEYS[1], 'reserved') or '0')
+if tonumber(used) + reserved + tonumber(ARGV[2]) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'r:' .. ARGV[3], ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'reserved', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# releases a reservation and records the tokens that were really spent
+SETTLE_SCRIPT = """
+local amount = redis.call('HGET', KEYS[1], 'r:' .. ARGV[1])
+if amount then
+    redis.call('HDEL', KEYS[1], 'r:' .. ARGV[1])
+    redis.call('HINCRBY', KEYS[1], 'reserved', -tonumber(amount))
+end
+if redis.call('HEXISTS', KEYS[1], 'used') == 1 then
+    redis.call('HINCRBY', KEYS[1], 'used', ARGV[2])
+end
+return amount and 1 or 0
+"""
+
+
+# returns the tokens of the messages in a thread's history list, counting
+# a token per byte of the messages that were never counted, and -1 if the
+# thread has no list
+HISTORY_TOKENS_SCRIPT = """
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+if #entries == 0 then
+    return -1
+end
+local tokens = 0
+for _, entry in ipairs(entries) do
+    local message = cjson.decode(entry)
+    if type(message[4]) == 'number' then
+        tokens = tokens + message[4]
+    else
+        tokens = tokens + string.len(message[3])
+    end
+end
+return tokens
+"""
+
+
+def get_ledger_key(user_id: UUID) -> str:
+    """get the key of a user's ledger"""
+    return f"quota:{user_id.hex}"
+
+
+def get_used_tokens(user_id: UUID) -> int:
+    """get the tokens spent by a user from the database"""
+    return db.session.scalar(
+        select(func.coalesce(func.sum(Thread.cost_total), 0)).where(
+            Thread.user_id == user_id
+        )
+    )
+
+
+def get_chat_tokens(*conditions, limit: "int | None" = None) -> int:
+    """
+    get the tokens of the non-empty chats of a thread matching `conditions`,
+    the chats that were never counted are assumed to cost a token per
+    character. With a `limit` only the most recent chats are counted
+    """
+    tokens = func.coalesce(Chat.content_tokens, func.length(Chat.content))
+    query = select(tokens).where(Chat.content != "", *conditions)
+    if limit is not None:
+        query = query.order_by(Chat.order.desc()).limit(limit)
+    return sum(db.session.scalars(query))
+
+
+def get_history_tokens(thread: "Thread") -> int:
+    """get the most tokens the history of a thread can add to a prompt"""
+    memory_type = config.CHATBOT_MEMORY_TYPE
+    if memory_type == "window":
+        # the window only holds the most recent chats within its budget
+        return config.CHATBOT_MEMORY_MAX_TOKENS
+    if memory_type == "summary":
+        # the summary followed by the turns it doesn't cover yet
+        (summary_tokens,) = count_tokens([thread.summary])
+        return summary_tokens + get_chat_tokens(
+            Chat.thread_id == thread.id,
+            Chat.order > thread.summary_order,
+            limit=config.CHATBOT_MEMORY_RECENT_TURNS * 2,
+        )
+    # the whole thread, summed from its history list without sending the
+    # messages over. The list is only missing for idle threads
+    count = app.redis.register_script(HISTORY_TOKENS_SCRIPT)
+    tokens = count(keys=[get_history_key(thread.id)])
+    if tokens == -1:
+        return get_chat_tokens(Chat.thread_id == thread.id)
+    return tokens
+
+
+def estimate_cost(user: "User", thread: "Thread", query: str) -> int:
+    """
+    estimate the tokens a query and its response will cost: the system
+    prompt, the thread's history, the query and the longest response
+    """
+    return (
+        get_system_prompt_tokens(user.first_name)
+        + get_history_tokens(thread)
+        + len(get_encoding().encode(query))
+        + config.MAX_RESPONSE_TOKENS
+    )
+
+
+def reserve_tokens(user: "User", amount: int) -> "str | None":
+    """
+    Reserve tokens from a user's quota.
+
+    Returns the id of the reservation, or None if the user has no tokens
+    left.
+    """
+    key = get_ledger_key(user.id)
+    reservation = uuid4().hex
+    reserve = app.redis.register_script(RESERVE_SCRIPT)
+    args = [user.max_chat_cost, amount, reservation, config.QUOTA_LEDGER_TTL]
+    reserved = reserve(keys=[key], args=args)
+    if reserved == -1:
+        logging.debug("Seeding quota ledger of %s", user.name)
+        app.redis.hsetnx(key, "used", get_used_tokens(user.id))
+        reserved = reserve(keys=[key], args=args)
+    if reserved != 1:
+        logging.info("%s has exhausted their quota", user.name)
+        return None
+    logging.debug("Reserved %d tokens for %s", amount, user.name)
+    return reservation
+
+
+def settle_tokens(user_id: UUID, reservation: str, cost: int) -> bool:
+    """
+    Release a reservation and record the real cost of the chat.
+
+    Returns False if the reservation does not exist (anymore).
+    """
+    settle = app.redis.register_script(SETTLE_SCRIPT)
+    settled = settle(keys=[get_ledger_key(user_id)], args=[reservation, cost])
+    logging.debug("Settled reservation %s with %d tokens", reservation, cost)
+    return bool(settled)
+
+
+def forget_used_tokens(user_id: UUID):
+    """
+    drop the spent tokens of a user's ledger, it is re-seeded from the
+    database the next time tokens are reserved
+    """
+    app.redis.hdel(get_ledger_key(user_id), "used")
@@ -0,0 +1,157 @@
+"""
+Writing the tokens of a response to its redis stream.
+
+Each entry of the stream holds one or more tokens:
+`{"token": <text>, "count": <tokens>}`. The last entry is the end of
+stream sentinel, `{"event": "end"}` or `{"event": "error", "error":
+<message>}`, readers stop when they get to it.
+"""
+import json
+import re
+from threading import Lock, Timer
+from time import monotonic
+from typing import Any, Optional
+
+from cookgpt import logging
+from cookgpt.ext.config import config
+from cookgpt.globals import current_app as app
+
+# the most entries kept in a stream
+STREAM_MAXLEN = 1000
+STREAM_ENTRY_ID = re.compile(r"^\d+-\d+$")
+
+
+def format_event(
+    event: str, data: Any, id: "Optional[bytes | str]" = None
+) -> str:
+    """
+    format a server-sent event, `data` is dumped as json unless it is
+    already a json string
+    """
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id.decode() if isinstance(id, bytes) else id}")
+    lines.append(f"event: {event}")
+    lines.append(
+        f"data: {data if isinstance(data, str) else json.dumps(data)}"
+    )
+    return "\n".join(lines) + "\n\n"
+
+
+def format_comment(comment: str) -> str:
+    """format a server-sent event comment, clients ignore them"""
+    return f": {comment}\n\n"
+
+
+def get_start_id(last_event_id: Optional[str]) -> str:
+    """get the stream entry id to read from after the last event"""
+    if last_event_id and STREAM_ENTRY_ID.match(last_event_id):
+        return last_event_id
+    return "0-0"
+
+
+class StreamWriter:
+    """
+    Buffers the tokens of a response and adds them to its stream in
+    batches.
+
+    The buffer is flushed once it holds `flush_bytes` bytes, or
+    `flush_interval` seconds after the last flush: by the next token, or
+    by a timer if the model stalls before it. So a token reaches the
+    stream at most `flush_interval` seconds after it is written. The
+    buffer is always flushed when the stream is closed.
+    """
+
+    def __init__(
+        self,
+        stream: str,
+        flush_interval: Optional[float] = None,
+        flush_bytes: Optional[int] = None,
+    ):
+        self.stream = stream
+        if flush_interval is None:
+            flush_interval = config.CHATBOT_STREAM_FLUSH_INTERVAL
+        if flush_bytes is None:
+            flush_bytes = config.CHATBOT_STREAM_FLUSH_BYTES
+        self.flush_interval: float = flush_interval
+        self.flush_bytes: int = flush_bytes
+        # the timer flushes outside of the app context
+        self.redis = app.redis
+        # the tokens and the token entries added to the stream
+        self.tokens = 0
+        self.entries = 0
+        self.closed = False
+        self._buffer: "list[str]" = []
+        self._buffer_bytes = 0
+        self._flushed_at = monotonic()
+        self._lock = Lock()
+        self._timer: "Optional[Timer]" = None
+
+    def write(self, token: str):
+        """add a token to the buffer, flushing it if it is due"""
+        with self._lock:
+            self._buffer.append(token)
+            self._buffer_bytes += len(token.encode())
+            wait = self._flushed_at + self.flush_interval - monotonic()
+            if self._buffer_bytes >= self.flush_bytes or wait <= 0:
+                self._flush()
+            elif self._timer is None:
+                self._timer = Timer(wait, self._flush_due)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_due(self):
+        """flush the tokens that have waited for `flush_interval`"""
+        with self._lock:
+            self._timer = None
+            if not self.closed:
+                self._flush()
+
+    def flush(self, *entries: "dict[str, str]"):
+        """add the buffered tokens and the given entries to the stream"""
+        with self._lock:
+            self._flush(*entries)
+
+    def _flush(self, *entries: "dict[str, str]"):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            token_entry = {
+                "token": "".join(self._buffer),
+                "count": len(self._buffer),
+            }
+            entries = (token_entry, *entries)
+            self.tokens += len(self._buffer)
+            self.entries += 1
+        if entries:
+            pipeline = self.redis.pipeline(transaction=False)
+            for entry in entries:
+                pipeline.xadd(self.stream, entry, maxlen=STREAM_MAXLEN)
+            pipeline.execute()
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        self._flushed_at = monotonic()
+
+    def close(self, error: Optional[BaseException] = None):
+        """flush the buffer and end the stream"""
+        sentinel = {"event": "end"}
+        if error is not None:
+            sentinel = {"event": "error", "error": str(error) or repr(error)}
+        with self._lock:
+            if self.closed:
+                return
+            self._flush(sentinel)
+            self.closed = True
+        logging.info(
+            "Streamed %d tokens in %d entries to %s (%d entries saved)",
+            self.tokens,
+            self.entries,
+            self.stream,
+            self.entries_saved,
+        )
+
+    @property
+    def entries_saved(self) -> int:
+        """the entries saved by batching compared to one per token"""
+        return self.tokens - self.entries
@@ -4,12 +4,13 @@ from uuid import UUID
 from redisflow import celeryapp as app
 
 
-@app.task(name="chatbot.send_query")
+@app.task(name="chatbot.send_query", ignore_result=True)
 def send_query(
     query_id: UUID,
     response_id: UUID,
     thread_id: UUID,
     kwargs: "dict[str, Any]",
+    reservation: "str | None" = None,
 ):
     """send query to ai and process response"""
 
@@ -17,7 +18,9 @@ def send_query(
     from cookgpt.chatbot.callback import ChatCallbackHandler
     from cookgpt.chatbot.chain import ThreadChain
     from cookgpt.chatbot.models import Chat, Thread
+    from cookgpt.chatbot.quota import settle_tokens
     from cookgpt.chatbot.utils import get_stream_name, use_chat_callback
+    from cookgpt.ext.config import config
     from cookgpt.ext.database import db
     from cookgpt.globals import current_app as app
     from cookgpt.globals import resetvar, setvar
@@ -41,8 +44,21 @@ def send_query(
     setvar("response", response)
     setvar("user", thread.user)
 
-    with use_chat_callback(ChatCallbackHandler()):
-        chain.predict(**kwargs)
+    callback = ChatCallbackHandler()
+    try:
+        with use_chat_callback(callback):
+            chain.predict(**kwargs)
+    except BaseException as error:
+        callback.end_stream(error)
+        raise
+    finally:
+        if reservation is not None:
+            # the memory has saved the costs computed by the callback
+            settle_tokens(
+                thread.user_id, reservation, query.cost + response.cost
+            )
+    # the memory has saved the chats, readers can stop at the end
+    callback.end_stream()
 
     stream = get_stream_name(thread.user, response)
     logging.info(f"Adding stream {stream!r} to completed streams")
@@ -55,3 +71,65 @@ def send_query(
     resetvar("query")
     resetvar("response")
     resetvar("user")
+
+    if config.CHATBOT_MEMORY_TYPE == "summary":
+        # update the summary off the request path
+        summarize_thread.delay(thread_id)
+
+
+@app.task(name="chatbot.summarize_thread")
+def summarize_thread(thread_id: UUID) -> bool:
+    """add the older turns of a thread to its rolling summary"""
+
+    from cookgpt.chatbot.memory import ThreadSummarizer
+    from cookgpt.chatbot.models import Thread
+    from cookgpt.ext.database import db
+
+    thread = db.session.get(Thread, thread_id)
+    if thread is None:  # pragma: no cover
+        # the thread was deleted in the meantime
+        return False
+    return ThreadSummarizer().summarize(thread)
+
+
+@app.task(name="chatbot.archive_threads")
+def archive_threads(
+    batch_size: "int | None" = None, idle_days: "int | None" = None
+) -> int:
+    """move the chats of closed and idle threads into the archive"""
+
+    from datetime import datetime, timedelta
+
+    from sqlalchemy import or_, select
+
+    from cookgpt import logging
+    from cookgpt.chatbot.models import Thread
+    from cookgpt.ext.database import db
+    from cookgpt.globals import current_app as app
+
+    batch_size = batch_size or app.config.CHATBOT_ARCHIVE_BATCH_SIZE
+    idle_days = idle_days or app.config.CHATBOT_ARCHIVE_IDLE_DAYS
+    idle_since = datetime.utcnow() - timedelta(days=idle_days)
+    logging.info("Archiving threads idle since %s", idle_since)
+
+    archived = 0
+    while True:
+        threads = db.session.scalars(
+            select(Thread)
+            .where(
+                ~Thread.archived,
+                Thread.chat_count > 0,
+                or_(Thread.closed, Thread.updated_at < idle_since),
+            )
+            .limit(batch_size)
+        ).all()
+        if not threads:
+            break
+        # the chats don't change, so cached responses stay valid
+        for thread in threads:
+            thread.archive(commit=False)
+        db.session.commit()
+        archived += len(threads)
+        logging.debug("Archived %d threads", archived)
+    logging.info("Archived %d threads", archived)
+    return archived
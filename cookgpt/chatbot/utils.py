@@ -1,6 +1,17 @@
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import TYPE_CHECKING, Literal, Optional, Sequence, cast
+from functools import lru_cache
+from hashlib import sha1
+from threading import Lock
+from typing import (
+    TYPE_CHECKING,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+    cast,
+)
 from uuid import UUID, uuid4
 
 import tiktoken
@@ -9,8 +20,15 @@ from langchain.schema.messages import BaseMessage
 
 from cookgpt import logging
 from cookgpt.chatbot.data.enums import MessageType
+from cookgpt.chatbot.data.prompts import (
+    render_system_prompt,
+    system_prompt_hash,
+    system_prompt_name_words,
+    system_prompt_static_parts,
+)
 from cookgpt.chatbot.models import Thread
 from cookgpt.ext.cache import cache
+from cookgpt.ext.config import config
 from cookgpt.ext.database import db
 from cookgpt.globals import getvar
 from cookgpt.utils import abort
@@ -20,75 +38,195 @@ if TYPE_CHECKING:
     from cookgpt.chatbot.callback import ChatCallbackHandler
     from cookgpt.chatbot.models import Chat
 
-encoding = tiktoken.get_encoding("cl100k_base")
 
+@lru_cache(maxsize=None)
+def get_encoding() -> "tiktoken.Encoding":
+    """load the tokenizer on first use"""
+    logging.debug("Loading the tokenizer...")
+    return tiktoken.get_encoding("cl100k_base")
 
-def num_tokens_from_messages(
+
+def prewarm_tokenizer():
+    """
+    Load the tokenizer ahead of the first request.
+
+    Called by the gunicorn and celery worker hooks. When it runs before
+    the worker processes are forked they share the tokenizer's memory.
+    """
+    get_encoding().encode("")
+
+
+# token counts of recently encoded texts, keyed by the hash of the text
+_token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+_token_counts_lock = Lock()
+
+
+def count_tokens(texts: Sequence[str]) -> "list[int]":
+    """
+    Count the tokens of each text.
+
+    The counts are kept in a bounded in-process LRU keyed by the hash of
+    the text, so repeated texts are only encoded once. When many texts
+    miss the LRU they are encoded in parallel by `encode_batch`.
+    """
+    keys = [sha1(text.encode()).digest() for text in texts]
+    counts: "list[Optional[int]]" = [None] * len(texts)
+    with _token_counts_lock:
+        for i, key in enumerate(keys):
+            if (count := _token_counts.get(key)) is not None:
+                _token_counts.move_to_end(key)
+                counts[i] = count
+
+    misses = {keys[i]: texts[i] for i, c in enumerate(counts) if c is None}
+    if misses:
+        if len(misses) >= config.TOKENIZER_BATCH_SIZE:
+            encoded = get_encoding().encode_batch(
+                list(misses.values()), num_threads=config.TOKENIZER_THREADS
+            )
+        else:
+            encoded = [get_encoding().encode(text) for text in misses.values()]
+        new_counts = dict(zip(misses, map(len, encoded)))
+        with _token_counts_lock:
+            _token_counts.update(new_counts)
+            while len(_token_counts) > config.TOKENIZER_CACHE_SIZE:
+                _token_counts.popitem(last=False)
+        for i, key in enumerate(keys):
+            if counts[i] is None:
+                counts[i] = new_counts[key]
+    return cast("list[int]", counts)
+
+
+def clear_token_counts():
+    """empty the in-process LRU of token counts"""
+    with _token_counts_lock:
+        _token_counts.clear()
+
+
+class TokenCount(NamedTuple):
+    """the cost of each message and how many of them were encoded"""
+
+    costs: "list[int]"
+    hits: int
+    misses: int
+
+    @property
+    def tokens(self) -> int:
+        """the tokens of the messages, including the reply priming"""
+        return sum(self.costs) + 2  # <im_start>assistant
+
+
+def count_message_tokens(
     messages: Sequence[dict], model="gpt-3.5-turbo-0613"
-):
-    """Returns the number of tokens used by a list of messages."""
+) -> TokenCount:
+    """
+    Count the tokens of a list of messages.
+
+    The cached costs are fetched at once, the remaining messages are
+    encoded in a batch and their costs are cached at once.
+    """
     from cookgpt.auth.models import User
 
-    num_tokens = 0
-    for message in messages:
+    user = getvar("user", _default=None, _type=User)
+    costs: "list[Optional[int]]" = [None] * len(messages)
+    ids = {i: cast(str, m["id"]) for i, m in enumerate(messages) if "id" in m}
+    if ids:
+        cached = cache.get_many(*(f"chat:{id}:cost" for id in ids.values()))
+        for i, cost in zip(ids, cached):
+            costs[i] = cost
+
+    misses: "list[int]" = []
+    for i, message in enumerate(messages):
         role = cast(Literal["user", "assistant", "system"], message["role"])
-        cost = 4
-
-        # check if message is cached
-        if "id" in message:
-            id = cast(str, message["id"])
-            cache_key = f"chat:{id}:cost"
-            if cache.has(cache_key):
-                logging.debug(
-                    "Using cached %s message cost for chat %r", role, id[:6]
-                )
-                num_tokens += cast(int, cache.get(cache_key))
-                continue  # pragma: no cover
-
-        # check if system message is cached
-        elif role == "system" and (
-            user := getvar("user", _default=None, _type=User)
-        ):
-            id = user.pk
-            cache_key = f"system_msg:{id}:cost"
-            if cache.has(cache_key):
-                logging.debug(
-                    "Using cached system message cost for %r", user.name
-                )
-                num_tokens += cast(int, cache.get(cache_key))
+        if costs[i] is not None:
+            continue
+        # count the system prompt from its pre-tokenized parts
+        if role == "system" and i not in ids and user is not None:
+            if message["content"] == render_system_prompt(user.first_name):
+                costs[i] = get_system_prompt_tokens(user.first_name)
                 continue
-        else:  # pragma: no cover
+        elif i not in ids:  # pragma: no cover
             if role == "system":
                 logging.warning("Working outside of user context. ")
             else:
                 logging.warning("ID not found in %s message.", role)
-        for key, value in message.items():
-            cost += len(encoding.encode(value))
-            if key == "name":  # pragma: no cover
+        misses.append(i)
+
+    if misses:
+        # the id is ours, it isn't sent to the AI. Every id is unique, so
+        # counting it would also push reusable texts out of the LRU
+        values = [
+            [v for k, v in messages[i].items() if k != "id"] for i in misses
+        ]
+        tokens = iter(count_tokens([v for m in values for v in m]))
+        for i, message_values in zip(misses, values):
+            cost = 4  # <im_start>{role/name}\n{content}<im_end>\n
+            for _ in message_values:
+                cost += next(tokens)
+            if "name" in messages[i]:  # pragma: no cover
                 cost += -1  # role is always required and always 1 token
-        logging.debug("Computed cost for %s message: %s", role, cost)
-        # cache the cost
-        if "id" in message:
-            id = cast(str, message["id"])
-            cache_key = f"chat:{id}:cost"
-            logging.debug("Caching cost for %s message %r", role, id[:6])
-            cache.set(cache_key, cost, timeout=0)
-        # cache the system message cost
-        elif role == "system" and (
-            user := getvar("user", _default=None, _type=User)
-        ):
-            id = user.pk
-            cache_key = f"system_msg:{id}:cost"
-            logging.debug("Caching system message cost for %r", user.name)
-            cache.set(cache_key, cost, timeout=0)
-        else:  # pragma: no cover
-            logging.warning(
-                "Unable to cache cost for %s message: %r", role, message
-            )
+            costs[i] = cost
+        new_costs = {
+            f"chat:{ids[i]}:cost": costs[i] for i in misses if i in ids
+        }
+        if new_costs:
+            cache.set_many(new_costs, timeout=0)
+
+    count = TokenCount(
+        costs=cast("list[int]", costs),
+        hits=len(messages) - len(misses),
+        misses=len(misses),
+    )
+    logging.debug(
+        "Counted %d tokens in %d messages (%d cached, %d encoded)",
+        count.tokens,
+        len(messages),
+        count.hits,
+        count.misses,
+    )
+    return count
+
+
+def num_tokens_from_messages(
+    messages: Sequence[dict], model="gpt-3.5-turbo-0613"
+):
+    """Returns the number of tokens used by a list of messages."""
+    return count_message_tokens(messages, model).tokens
+
 
-        num_tokens += cost
-    num_tokens += 2  # every reply is primed with <im_start>assistant
-    return num_tokens
+@lru_cache(maxsize=None)
+def get_system_prompt_parts_tokens() -> int:
+    """
+    Count the tokens of the static parts of the system prompt.
+
+    The count is shared through the cache under the hash of the template,
+    so a changed template is counted again.
+    """
+    cache_key = f"system_prompt:{system_prompt_hash}:static_tokens"
+    tokens = cache.get(cache_key)
+    if tokens is None:
+        tokens = sum(
+            len(get_encoding().encode(p)) for p in system_prompt_static_parts
+        )
+        logging.debug("Caching system prompt %s tokens", system_prompt_hash)
+        cache.set(cache_key, tokens, timeout=0)
+    return tokens
+
+
+@lru_cache(maxsize=1024)
+def get_system_prompt_tokens(user: str) -> int:
+    """
+    count the tokens of the system message rendered for a user, only the
+    words holding the user's name are encoded
+    """
+    return (
+        4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        + len(get_encoding().encode("system"))
+        + get_system_prompt_parts_tokens()
+        + sum(
+            len(get_encoding().encode(word.replace("{user}", user)))
+            for word in system_prompt_name_words
+        )
+    )
 
 
 def convert_message_to_dict(message: "BaseMessage") -> dict:
@@ -123,13 +261,19 @@ def use_chat_callback(cb: "Optional[ChatCallbackHandler]" = None):
         cb.unregister()
 
 
-def get_thread(thread_id: str | UUID, required=True):
-    """Get a thread using it's ID"""
+def get_thread(thread_id: str | UUID, required=True, restore=True):
+    """
+    Get a thread using it's ID
+
+    The chats of an archived thread are restored unless `restore` is False.
+    """
     if isinstance(thread_id, str):  # pragma: no cover
         thread_id = UUID(thread_id)
     thread = db.session.get(Thread, thread_id)
     if not thread and required:  # pragma: no cover
         abort(404, "Thread not found")
+    if thread and thread.archived and restore:
+        thread.restore()
     return thread
 
 
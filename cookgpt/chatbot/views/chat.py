@@ -1,5 +1,5 @@
 """Chatbot chat views"""
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, Optional
 from uuid import UUID
 
 from apiflask.views import MethodView
@@ -12,13 +12,14 @@ from cookgpt.chatbot.data import examples as ex
 from cookgpt.chatbot.data import schemas as sc
 from cookgpt.chatbot.memory import get_memory_input_key
 from cookgpt.chatbot.models import Chat
+from cookgpt.chatbot.quota import estimate_cost, reserve_tokens, settle_tokens
 from cookgpt.chatbot.utils import get_stream_name, get_thread, make_dummy_chat
 from cookgpt.ext import db
 from cookgpt.ext.auth import auth_required
 from cookgpt.ext.cache import (
     cache,
     chat_cache_key,
-    chats_cache_key,
+    chats_page_cache_key,
     threads_cache_key,
 )
 from cookgpt.utils import abort, api_output
@@ -50,14 +51,22 @@ class ChatsView(MethodView):
         description="An error when the specified thread is not found",
     )
     @app.doc(description=docs.CHAT_GET_CHATS)
-    @cache.cached(timeout=0, make_cache_key=chats_cache_key)
+    @cache.cached(make_cache_key=chats_page_cache_key)
     def get(self, query_data):
-        """Get all messages in a thread."""
-        logging.info("GET all chats from thread")
+        """Get a page of messages in a thread."""
+        logging.info("GET chats from thread")
         thread = get_thread(query_data["thread_id"])
         logging.info("Using thread %s", thread.id)
+        chats, next_cursor = thread.get_chats(
+            query_data["limit"],
+            before=query_data.get("before"),
+            after=query_data.get("after"),
+        )
 
-        return {"chats": [sc.parse_chat(chat) for chat in thread.chats]}
+        return {
+            "chats": [sc.parse_chat(chat) for chat in chats],
+            "next_cursor": next_cursor,
+        }
 
     @app.input(sc.Chats.Delete.Body, example=ex.Chats.Delete.Body)
     @app.output(
@@ -168,36 +177,43 @@ class ChatView(MethodView):
         else:
             logging.info("POST chat to thread")
         logging.info("Using thread %s", thread.id)
-        if thread.cost >= user.max_chat_cost:
+        reservation = reserve_tokens(user, estimate_cost(user, thread, query))
+        if reservation is None:
             return (
                 make_dummy_chat(
                     "You don't have enough tokens to make this request.",
-                    previous_chat_id=thread.last_chat.id
-                    if thread.last_chat
-                    else None,
+                    previous_chat_id=thread.last_chat_id,
                     thread_id=thread.id,
                     streaming=False,
                 ),
                 200,
             )
-        q = thread.add_query("")
-        r = thread.add_response("", previous_chat=q)
-        stream = get_stream_name(user, r)
-        if stream_response:
-            # Run the task in the background
-            logging.info("Sending query to AI in background")
-            task = celeryapp.send_task(
-                "chatbot.send_query",
-                args=(q.id, r.id, thread.id, {input_key: query}),
-            )
-            app.redis.set(f"{stream}:task", task.id)
-        else:
-            # Run the task in the foreground
-            logging.info("Sending query to AI in foreground")
-            send_query(q.id, r.id, thread.id, {input_key: query})
-            app.redis.set(f"{stream}:task", "")
-        db.session.refresh(r)
-        db.session.refresh(q)
+        try:
+            q, r = thread.add_exchange()
+            stream = get_stream_name(user, r)
+            args = (q.id, r.id, thread.id, {input_key: query}, reservation)
+            if stream_response:
+                # Run the task in the background
+                logging.info("Sending query to AI in background")
+                # readers stop at the end of the stream, so the result of
+                # the task is not needed
+                task = celeryapp.send_task(
+                    "chatbot.send_query", args=args, ignore_result=True
+                )
+                app.redis.set(f"{stream}:task", task.id)
+            else:
+                # Run the task in the foreground
+                logging.info("Sending query to AI in foreground")
+                send_query(*args)
+                app.redis.set(f"{stream}:task", "")
+                # the task writes the chats using its own session
+                db.session.expire(q)
+                db.session.refresh(r)
+        except BaseException:
+            # release the reservation if the task was never sent,
+            # settling it again with no cost is harmless
+            settle_tokens(user.id, reservation, 0)
+            raise
         return {
             "chat": r,
             "streaming": stream_response,
@@ -215,13 +231,11 @@ class ChatView(MethodView):
 # @auth_required()
 def read_stream(chat_id: UUID):
     """Read a streamed response bit by bit."""
-    from time import sleep
-
     from flask import Response
 
     from cookgpt.ext import db
+    from cookgpt.ext.config import config
     from cookgpt.globals import current_app as app
-    from redisflow import celeryapp
 
     logging.info("GET stream for chat %s", chat_id)
     OutputT = list[tuple[bytes, list[tuple[bytes, dict[bytes, bytes]]]]]
@@ -233,9 +247,8 @@ def read_stream(chat_id: UUID):
     user: "User" = chat.thread.user
     stream = get_stream_name(user, chat)
 
-    if chat.content != "" or not (
-        app.redis.exists(stream) and app.redis.exists(f"{stream}:task")
-    ):  # chat has been streamed
+    if chat.content != "" or not app.redis.exists(f"{stream}:task"):
+        # chat has been streamed
         logging.debug("Chat has already been streamed")
         entries: list[str] = []
         for word in chat.content.split(" "):
@@ -248,39 +261,127 @@ def read_stream(chat_id: UUID):
 
     def get_stream(entry_id: bytes):
         logging.debug("Streaming %r from %s", stream, entry_id)
-
-        task_id = app.redis.get(f"{stream}:task")
+        timeout = config.CHATBOT_STREAM_TIMEOUT
 
         while True:
-            # check if there are any new entries in the stream
+            # wait for new entries in the stream
             entries: OutputT = app.redis.xread(  # type: ignore
-                {stream: entry_id}
+                {stream: entry_id}, block=timeout * 1000
             )
-            if entries:
-                # there are new entries in the stream
-                logging.debug("New entries in stream")
-                _, data = entries[0]
-                for entry_id, entry in data:
-                    yield entry[b"token"]
-            elif task_id:
-                # there are no new entries in the stream, check if task is
-                # complete
-                logging.debug("No new entries in stream")
-                task = celeryapp.AsyncResult(task_id)
-                if task.ready():
-                    # task is complete, stop streaming
-                    logging.debug("Task is complete")
-                    break
-            else:  # pragma: no cover
-                # there are no new entries in the stream and no task
-                # running, stop streaming
-                logging.debug("No task running")
+            if not entries:  # pragma: no cover
+                # the task died without ending the stream
+                logging.warning("No entries in %r for %ds", stream, timeout)
                 break
-            sleep(0.1)
-
+            logging.debug("New entries in stream")
+            _, data = entries[0]
+            for entry_id, entry in data:
+                if b"event" in entry:
+                    # the end of stream sentinel
+                    if entry[b"event"] == b"error":
+                        logging.warning(
+                            "Stream %r ended with an error: %s",
+                            stream,
+                            entry[b"error"].decode(),
+                        )
+                    return
+                yield entry[b"token"]
+
+    # end the transaction so the response doesn't hold on to a database
+    # connection while it waits for tokens
+    db.session.commit()
     return Response(stream_with_context(get_stream(b"0-0")), status=200)
 
 
+@app.get("stream/<uuid:chat_id>/events")
+@api_output(
+    {},
+    content_type="text/event-stream",
+    status_code=200,
+    description="A streamed response as server-sent events",
+)
+@app.doc(description=docs.CHAT_READ_STREAM_EVENTS)
+@auth_required(locations=["headers", "query_string"])
+def read_stream_events(chat_id: UUID):
+    """Read a streamed response as server-sent events."""
+    from flask import Response, request
+
+    from cookgpt.chatbot.stream import (
+        format_comment,
+        format_event,
+        get_start_id,
+    )
+    from cookgpt.ext import db
+    from cookgpt.ext.config import config
+    from cookgpt.globals import current_app as app
+
+    logging.info("GET stream events for chat %s", chat_id)
+    OutputT = list[tuple[bytes, list[tuple[bytes, dict[bytes, bytes]]]]]
+
+    chat = db.session.get(Chat, chat_id)
+    if not chat:
+        abort(404, "Chat does not exist.")
+    user: "User" = get_current_user()
+    if chat.thread.user_id != user.id:
+        abort(403, "Chat belongs to another user.")
+    stream = get_stream_name(user, chat)
+    # a chat with content, or without a task, is not being streamed
+    streaming = chat.content == "" and bool(app.redis.exists(f"{stream}:task"))
+    start_id = get_start_id(request.headers.get("Last-Event-ID"))
+    logging.debug("Streaming %r from %s", stream, start_id)
+
+    def done(entry_id: "Optional[bytes]" = None) -> str:
+        # the task saves the chat before it ends the stream
+        db.session.refresh(chat)
+        data = sc.ChatSchema().dumps(sc.parse_chat(chat))
+        return format_event("done", data, entry_id)
+
+    def get_events():
+        entry_id = start_id
+        heartbeat = config.CHATBOT_STREAM_HEARTBEAT
+        idle = 0
+        while True:
+            entries: OutputT = app.redis.xread(  # type: ignore
+                {stream: entry_id},
+                block=heartbeat * 1000 if streaming else None,
+            )
+            if not entries:
+                if not streaming:
+                    # the whole stream (if it was kept) has been sent
+                    yield done()
+                    return
+                idle += heartbeat
+                if idle >= config.CHATBOT_STREAM_TIMEOUT:  # pragma: no cover
+                    logging.warning("No entries in %r for %ds", stream, idle)
+                    return
+                yield format_comment("heartbeat")
+                continue
+            idle = 0
+            _, data = entries[0]
+            for entry_id, entry in data:
+                if entry.get(b"event") == b"error":
+                    error = entry[b"error"].decode()
+                    yield format_event("error", {"error": error}, entry_id)
+                    return
+                if entry.get(b"event") == b"end":
+                    yield done(entry_id)
+                    return
+                token = {
+                    "token": entry[b"token"].decode(),
+                    "count": int(entry[b"count"]),
+                }
+                yield format_event("token", token, entry_id)
+
+    # end the transaction so the response doesn't hold on to a database
+    # connection while it waits for tokens, `done` starts a new one
+    db.session.commit()
+    return Response(
+        stream_with_context(get_events()),
+        status=200,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 app.add_url_rule(
     "/<uuid:chat_id>",
     view_func=ChatView.as_view("single_chat"),
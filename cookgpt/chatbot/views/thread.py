@@ -29,7 +29,7 @@ class ThreadView(MethodView):
     def get(self, thread_id: UUID):
         """Get details of a thread."""
         logging.info(f"GET thread using id {thread_id}")
-        thread = get_thread(thread_id)
+        thread = get_thread(thread_id, restore=False)
         return sc.Thread.Get.Response().dump(thread)
 
     @app.input(sc.Thread.Post.Body, example=ex.Thread.Post.Body)
@@ -55,7 +55,7 @@ class ThreadView(MethodView):
         """Modify a thread's information"""
         title = json_data.get("title")
         logging.info(f"PATCH thread {title!r}")
-        thread = get_thread(thread_id)
+        thread = get_thread(thread_id, restore=False)
         if title:
             logging.debug(f"Updating thread title to {title!r}")
             thread.update(title=title)
@@ -67,7 +67,7 @@ class ThreadView(MethodView):
     def delete(self, thread_id: UUID):
         """Delete a thread and all chats within it"""
         logging.info(f"DELETE thread {thread_id!r}")
-        thread = get_thread(thread_id)
+        thread = get_thread(thread_id, restore=False)
         thread.delete()
         return {"message": "Thread deleted successfully"}
 
@@ -84,7 +84,7 @@ class ThreadsView(MethodView):
         user: "User" = get_current_user()
         logging.info("GET all threads")
         return sc.Threads.Get.Response().dump(
-            {"threads": user.get_active_threads()}
+            {"threads": user.get_thread_summaries()}
         )
 
     @app.output(sc.Threads.Delete.Response)
@@ -60,13 +60,17 @@ Chats with the AI are organized into threads. Each thread has a unique ID that i
 
 Each user has a `max_chat_cost` which is the total number of tokens that he/she is allowed to spend on chats with the AI assistant. The cost of a chat is the number of tokens used in the query and the response.
 
+While a query is being answered, an estimate of its cost is reserved from the user's tokens: the system prompt, the history sent with the query (the whole thread, the window or the summary and recent turns, depending on the memory), the query and the longest response allowed. A query whose estimate doesn't fit into the tokens left is refused, which keeps concurrent queries within `max_chat_cost`. The estimate is not an exact count, so the real cost of a chat can differ slightly from it. The reservation is replaced by the real cost once the response is complete. Deleting chats gives their tokens back to the user.
+
 > Subsequent versions of the API will allow users to purchase more tokens.
 
 ### Chat Memory Optimization
-For now, the AI's memory has not been optimized and it remembers all chats that it has had with the user. This means that the AI's memory will grow linearly as the user interact with it. This will be fixed in subsequent versions of the API."""
+By default, the AI remembers all chats in a thread. This means that the AI's memory grows linearly as the user interacts with it. When the server runs with the `window` memory, the AI only remembers the most recent chats that fit into a fixed number of tokens. With the `summary` memory, it remembers a summary of the older chats, which is updated in the background after every response, and the most recent chats."""
+
 
+CHAT_GET_CHATS = """Use this endpoint to get the messages exchanged between the user and the ai in a thread. The chats are paginated and sorted in the order they were sent.
 
-CHAT_GET_CHATS = """Use this endpoint to get a list of all messages exchanged between the user and the ai in a thread. The chats are sorted in descending order of the last message sent in the thread."""
+Without a cursor, the most recent `limit` chats are returned. To load older chats, pass the `next_cursor` from the response as the `before` query parameter. To load chats sent after a known chat, pass its cursor as `after`; the `next_cursor` of that response should then be used as `after` as well. `next_cursor` is `null` when there are no more chats."""
 
 
 CHAT_DELETE_CHATS = """Use this endpoint to delete all chats in the thread. **This action cannot be undone**."""
@@ -91,3 +95,11 @@ If the user does not have enough tokens to send the message, a dummy response wi
 > INFO: To identify a dummy response, check if the `chat.cost` field is `0`."""
 
 CHAT_READ_STREAM = """Use this endpoint to read the AI assistant's response bit by bit. This endpoint is used when the AI assistant is streaming it's response. The `chat_id` url parameter is used to specify the chat that you want to read from. The `id` field in the response body from the `/chat` endpoint contains the `chat_id`."""
+
+CHAT_READ_STREAM_EVENTS = """Use this endpoint to read the AI assistant's response as [server-sent events](https://html.spec.whatwg.org/multipage/server-sent-events.html), for example with an `EventSource`. The `chat_id` url parameter is used to specify the chat that you want to read from.
+
+As an `EventSource` can't set headers, the access token can be sent in the `access_token` query parameter instead of the `Authorization` header. Only the chats of the token's user can be read.
+
+Each `token` event carries a part of the response as `{"token": "...", "count": 1}`. The `id` of every event is its position in the stream: a client that reconnects with the `Last-Event-ID` header only receives the events after it. Comments are sent as heartbeats while the AI assistant is thinking.
+
+The stream ends with a `done` event that carries the saved chat, or with an `error` event that carries `{"error": "..."}` if the response failed."""
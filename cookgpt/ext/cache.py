@@ -3,6 +3,7 @@ Application cache.
 """
 
 from typing import TYPE_CHECKING
+from uuid import uuid4
 
 import click
 from flask import request
@@ -50,12 +51,39 @@ def chat_cache_key(*args, **kwargs) -> str:
     return f"chat:{chat_id}"
 
 
-def chats_cache_key(*args, **kwargs) -> str:
-    """get the cache key for a thread's chats"""
+def get_chats_thread_id(**kwargs) -> str:
+    """get the id of the thread whose chats are cached"""
     thread_id = kwargs.get("thread_id")
     if thread_id is None:
         thread_id = request.args["thread_id"]
-    return f"chats:{thread_id}"
+    return str(thread_id)
+
+
+def chats_cache_key(*args, **kwargs) -> str:
+    """
+    get the cache key for the version of a thread's cached chat pages,
+    deleting it invalidates every page
+    """
+    # `chats:<thread id>` used to hold whole responses, the version has a
+    # key of its own so those are never read as one
+    return f"chats:{get_chats_thread_id(**kwargs)}:version"
+
+
+def chats_page_cache_key(*args, **kwargs) -> str:
+    """
+    get the cache key for a page of a thread's chats
+
+    Pages are namespaced by the version stored under `chats_cache_key`.
+    """
+    version_key = chats_cache_key(*args, **kwargs)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid4().hex
+        cache.set(version_key, version, timeout=0)
+    page = ":".join(
+        request.args.get(arg, "") for arg in ("limit", "before", "after")
+    )
+    return f"chats:{get_chats_thread_id(**kwargs)}:{version}:{page}"
 
 
 def init_app(app: "App"):
@@ -1,6 +1,6 @@
 from typing import TYPE_CHECKING, cast
 
-from redis import Redis  # type: ignore
+from redis import BlockingConnectionPool, Redis  # type: ignore
 
 from cookgpt.globals import setvar
 
@@ -18,7 +18,18 @@ def init_app(app: "App"):
         return
 
     logging.debug("Initializing redis")
-    redis = cast(Redis, Redis.from_url(app.config.REDIS_URL))
+    max_connections = app.config.REDIS_MAX_CONNECTIONS
+    if max_connections:
+        # wait for a free connection instead of failing when they are all
+        # in use, as many greenlets share the pool of a gevent worker
+        pool = BlockingConnectionPool.from_url(
+            app.config.REDIS_URL,
+            max_connections=max_connections,
+            timeout=app.config.REDIS_POOL_TIMEOUT,
+        )
+        redis = Redis(connection_pool=pool)
+    else:
+        redis = cast(Redis, Redis.from_url(app.config.REDIS_URL))
     app.redis = redis
     celeryapp.init_app(app)
     setvar("redis", redis)
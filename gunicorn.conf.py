@@ -1,5 +1,16 @@
 import os
 
+# Worker Processes
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+if worker_class == "gevent":  # pragma: no cover
+    # patch before anything imports socket, ssl or threading
+    from gevent import monkey
+
+    monkey.patch_all()
+
+# open connections per gevent worker, each open stream holds one
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
 # Server Socket
 wsgi_app = os.environ["FLASK_APP"]
 reload = os.getenv("GUNICORN_RELOAD", "0") == "1"
@@ -11,3 +22,22 @@ threads = int(os.getenv("GUNICORN_THREADS", "1"))
 
 # Logging
 loglevel = os.getenv("GUNICORN_LOG_LEVEL", os.getenv("LOG_LEVEL", "info"))
+
+# Tokenizer
+TOKENIZER_PRELOAD = os.getenv("GUNICORN_TOKENIZER_PRELOAD", "1") == "1"
+
+
+def on_starting(server):
+    """load the tokenizer before forking, so the workers share it"""
+    if TOKENIZER_PRELOAD:
+        import tiktoken
+
+        # keep in sync with cookgpt.chatbot.utils.get_encoding
+        tiktoken.get_encoding("cl100k_base")
+
+
+def post_worker_init(worker):
+    """make sure the tokenizer is loaded before the worker takes requests"""
+    from cookgpt.chatbot.utils import prewarm_tokenizer
+
+    prewarm_tokenizer()
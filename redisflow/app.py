@@ -1,5 +1,19 @@
+from celery.signals import worker_init, worker_process_init
+
 from cookgpt import create_app_wsgi
 from redisflow import celeryapp as app
 
 webapp = create_app_wsgi()
 app.init_app(webapp)
+
+
+@worker_init.connect
+@worker_process_init.connect
+def prewarm_worker(**kwargs):
+    """
+    load the tokenizer before the worker takes tasks, the main process
+    loads it before the pool is forked so the pool processes share it
+    """
+    from cookgpt.chatbot.utils import prewarm_tokenizer
+
+    prewarm_tokenizer()
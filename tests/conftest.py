@@ -17,6 +17,16 @@ if TYPE_CHECKING:  # pragma: no cover
 pytest_plugins = ("celery.contrib.pytest",)
 
 
+def pytest_collection_modifyitems(config, items):
+    """skip the benchmarks unless they are selected with `-m benchmark`"""
+    if "benchmark" in (config.getoption("markexpr") or ""):
+        return
+    skip = pytest.mark.skip(reason="selected with -m benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture(scope="session")
 def app() -> Generator["App", None, None]:
     """An instance of the Flask application"""
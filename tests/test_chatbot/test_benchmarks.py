@@ -0,0 +1,380 @@
+"""
+Benchmarks for the chatbot's hot paths.
+
+The tests compare the same operation on a short and a long thread and
+assert that the statements it runs do not grow with the thread's length.
+The timing runs on large threads are marked `benchmark`, they are
+skipped unless selected with `-m benchmark` (`make benchmark`).
+"""
+from statistics import median
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import pytest
+
+from cookgpt.chatbot.models import Thread
+from cookgpt.globals import resetvar, setvar
+from tests.utils import count_queries, seed_chats
+
+if TYPE_CHECKING:
+    from cookgpt.auth.models import User
+
+SHORT_THREAD = 10
+LONG_THREAD = 200
+BENCHMARK_THREAD = 10_000
+SAMPLES = 20
+
+
+def time_inserts(thread: "Thread") -> "tuple[float, int]":
+    """return the median latency and query count of `add_chat`"""
+    timings: "list[float]" = []
+    queries = 0
+    for _ in range(SAMPLES):
+        with count_queries() as statements:
+            start = perf_counter()
+            thread.add_query("How long do I boil an egg?", cost=1)
+            timings.append(perf_counter() - start)
+        queries = len(statements)
+    return median(timings), queries
+
+
+class TestAddChatBenchmark:
+    def test_constant_insert_queries(self, user):
+        short = user.create_thread(title="Short Thread")
+        long = user.create_thread(title="Long Thread")
+        seed_chats(short.id, SHORT_THREAD)
+        seed_chats(long.id, LONG_THREAD)
+
+        _, short_queries = time_inserts(short)
+        _, long_queries = time_inserts(long)
+
+        assert long.chat_count == LONG_THREAD + SAMPLES
+        assert long.last_chat is not None
+        assert long.last_chat.order == LONG_THREAD + SAMPLES - 1
+        assert long_queries == short_queries
+        short.delete()
+        long.delete()
+
+    @pytest.mark.benchmark
+    def test_insert_latency(self, user):
+        short = user.create_thread(title="Short Thread")
+        long = user.create_thread(title="Long Thread")
+        seed_chats(short.id, SHORT_THREAD)
+        seed_chats(long.id, BENCHMARK_THREAD)
+
+        short_latency, _ = time_inserts(short)
+        long_latency, _ = time_inserts(long)
+        print(
+            f"add_chat: {short_latency * 1000:.2f}ms ({SHORT_THREAD} chats), "
+            f"{long_latency * 1000:.2f}ms ({BENCHMARK_THREAD} chats)"
+        )
+        short.delete()
+        long.delete()
+
+
+class TestClearBenchmark:
+    def test_clear_long_thread(self, thread: "Thread"):
+        seed_chats(thread.id, LONG_THREAD)
+        with count_queries() as statements:
+            thread.clear()
+
+        assert len(statements) <= 8
+        assert thread.chat_count == 0
+        assert thread.cost == 0
+        assert thread.last_chat is None
+        assert len(thread.chats) == 0  # type: ignore
+
+    @pytest.mark.benchmark
+    def test_clear_latency(self, thread: "Thread"):
+        seed_chats(thread.id, BENCHMARK_THREAD)
+        start = perf_counter()
+        thread.clear()
+        elapsed = perf_counter() - start
+        print(f"clear: {elapsed * 1000:.2f}ms ({BENCHMARK_THREAD} chats)")
+
+
+def time_history_loading(thread: "Thread") -> "tuple[float, float]":
+    """
+    return the median latency of loading a thread's messages through
+    the ORM and through the column projection used by the memory
+    """
+    from langchain.schema import AIMessage, HumanMessage
+
+    from cookgpt.chatbot.memory import SingleThreadHistory, make_message
+    from cookgpt.chatbot.models import Chat, MessageType
+
+    def load_models():
+        chats = Chat.query.filter(
+            Chat.thread_id == thread.id, Chat.content != ""
+        ).order_by(Chat.order)
+        return [
+            (
+                HumanMessage
+                if chat.chat_type == MessageType.QUERY
+                else AIMessage
+            )(content=chat.content, additional_kwargs={"id": chat.sid})
+            for chat in chats
+        ]
+
+    def load_columns():
+        return [make_message(*row[:3]) for row in history.select_chats()]
+
+    history = SingleThreadHistory()
+    count = thread.chat_count
+    timings: "dict[str, list[float]]" = {"models": [], "columns": []}
+    for _ in range(3):
+        for name, load in (("models", load_models), ("columns", load_columns)):
+            start = perf_counter()
+            messages = load()
+            timings[name].append(perf_counter() - start)
+            assert len(messages) == count
+            # the loaded models are not kept in the identity map
+            del messages
+    return median(timings["models"]), median(timings["columns"])
+
+
+class TestHistoryLoadingBenchmark:
+    def test_column_projection(self, thread: "Thread"):
+        from cookgpt.chatbot.memory import SingleThreadHistory
+        from cookgpt.ext import db
+
+        seed_chats(thread.id, LONG_THREAD)
+        # load the thread before counting
+        assert thread.chat_count == LONG_THREAD
+        loaded = set(db.session.identity_map.keys())
+        setvar("thread", thread)
+        try:
+            with count_queries() as statements:
+                messages = SingleThreadHistory().get_messages()
+        finally:
+            resetvar("thread")
+
+        assert len(messages) == LONG_THREAD
+        assert len(statements) == 1
+        # the chats are read as rows, not loaded as models
+        assert set(db.session.identity_map.keys()) == loaded
+
+    @pytest.mark.benchmark
+    def test_loading_latency(self, user):
+        for size in (1000, BENCHMARK_THREAD):
+            thread = user.create_thread(title="History Thread")
+            seed_chats(thread.id, size)
+            setvar("thread", thread)
+            try:
+                models, columns = time_history_loading(thread)
+            finally:
+                resetvar("thread")
+            print(
+                f"load history ({size} chats): {models * 1000:.2f}ms "
+                f"(models), {columns * 1000:.2f}ms (columns)"
+            )
+            thread.delete()
+
+
+class TestTokenCountingBenchmark:
+    @pytest.mark.benchmark
+    def test_cold_and_warm_counting(self, thread: "Thread"):
+        from cookgpt.chatbot.memory import SingleThreadHistory
+        from cookgpt.chatbot.utils import (
+            clear_token_counts,
+            convert_message_to_dict,
+            count_message_tokens,
+        )
+        from cookgpt.ext.cache import cache
+
+        seed_chats(thread.id, 2000)
+        setvar("thread", thread)
+        try:
+            messages = [
+                convert_message_to_dict(m)
+                for m in SingleThreadHistory().get_messages()
+            ]
+        finally:
+            resetvar("thread")
+
+        cache.clear()
+        clear_token_counts()
+        start = perf_counter()
+        cold = count_message_tokens(messages)
+        cold_time = perf_counter() - start
+        # the redis cache is lost, the process still knows the texts
+        cache.clear()
+        start = perf_counter()
+        warm = count_message_tokens(messages)
+        warm_time = perf_counter() - start
+        start = perf_counter()
+        hot = count_message_tokens(messages)
+        hot_time = perf_counter() - start
+        print(
+            f"count tokens (2000 chats): {cold_time * 1000:.2f}ms (cold), "
+            f"{warm_time * 1000:.2f}ms (in-process), "
+            f"{hot_time * 1000:.2f}ms (cached)"
+        )
+
+        assert cold.misses == warm.misses == len(messages)
+        assert hot.hits == len(messages)
+        assert cold.costs == warm.costs == hot.costs
+
+
+def time_gateway_fan_out(
+    user: "User", access_token: str, clients: int, rounds: int
+) -> "tuple[float, int]":
+    """
+    return the median latency of delivering a round of tokens to `clients`
+    http connections to the gateway, served by uvicorn and each reading the
+    events of its own response, and the XREADs that returned entries. The
+    clients share the server's event loop, so the latency is an upper bound
+    """
+    import asyncio
+
+    import uvicorn
+    from redis.asyncio import Redis
+    from sqlalchemy import select, update
+
+    from cookgpt.chatbot.gateway import StreamGateway
+    from cookgpt.chatbot.models import Chat
+    from cookgpt.ext import db
+    from cookgpt.globals import current_app as app
+
+    class Server(uvicorn.Server):
+        def install_signal_handlers(self):
+            """leave the signals to pytest"""
+
+    thread = user.create_thread(title="Fan out")
+    seed_chats(thread.id, clients)
+    # every response is still being streamed
+    condition = Chat.thread_id == thread.id
+    db.session.execute(update(Chat).where(condition).values(content=""))
+    db.session.commit()
+    chat_ids = db.session.scalars(select(Chat.id).where(condition)).all()
+    streams = [f"stream:{chat_id.hex}" for chat_id in chat_ids]
+    app.redis.mset({f"{stream}:task": "task-id" for stream in streams})
+
+    async def main():
+        redis = Redis.from_url(app.config.REDIS_URL)
+        # the gateway connects through its own pool, as when it is deployed
+        gateway = StreamGateway(app)
+        server = Server(
+            uvicorn.Config(
+                gateway,
+                port=0,
+                lifespan="off",
+                log_level="warning",
+                backlog=clients,
+            )
+        )
+        serving = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        # clients that received the token of each round
+        arrivals = [0] * (rounds + 1)
+        delivered = [asyncio.Event() for _ in range(rounds + 1)]
+
+        async def connect(chat_id):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(
+                f"GET /chat/stream/{chat_id}/events HTTP/1.1\r\n"
+                f"Host: gateway\r\n"
+                f"Authorization: Bearer {access_token}\r\n\r\n".encode()
+            )
+            await writer.drain()
+            return reader, writer
+
+        async def listen(reader: "asyncio.StreamReader"):
+            status = await reader.readline()
+            assert b" 200 " in status, status
+            for i in range(1, rounds + 1):
+                await reader.readuntil(b"event: token")
+                arrivals[i] += 1
+                if arrivals[i] == clients:
+                    delivered[i].set()
+
+        connections = []
+        for batch in range(0, clients, 200):
+            connections += await asyncio.gather(
+                *(connect(chat_id) for chat_id in chat_ids[batch:][:200])
+            )
+        listeners = [asyncio.create_task(listen(r)) for r, _ in connections]
+
+        async def subscribed():
+            while sum(map(len, gateway.hub.subscriptions.values())) < clients:
+                await asyncio.sleep(0.01)
+
+        # wait for every client to be authenticated and subscribed
+        await asyncio.wait_for(subscribed(), 60)
+
+        timings: "list[float]" = []
+        for i in range(1, rounds + 1):
+            pipeline = redis.pipeline(transaction=False)
+            for stream in streams:
+                pipeline.xadd(stream, {"token": f" {i}", "count": 1})
+            start = perf_counter()
+            await pipeline.execute()
+            await asyncio.wait_for(delivered[i].wait(), 10)
+            timings.append(perf_counter() - start)
+
+        await asyncio.gather(*listeners)
+        for _, writer in connections:
+            writer.close()
+        server.should_exit = True
+        await serving
+        await gateway.hub.close()
+        await gateway.redis.connection_pool.disconnect()
+        await redis.delete(*streams, *(f"{s}:task" for s in streams))
+        await redis.aclose()
+        return median(timings), gateway.hub.hits
+
+    try:
+        return asyncio.run(main())
+    finally:
+        thread.delete()
+
+
+class TestStreamGatewayBenchmark:
+    def test_one_read_serves_every_subscriber(self):
+        import asyncio
+        from uuid import uuid4
+
+        from redis.asyncio import Redis
+
+        from cookgpt.chatbot.gateway import StreamHub
+        from cookgpt.globals import current_app as app
+
+        streams = [f"stream:{uuid4().hex}" for _ in range(200)]
+        for stream in streams:
+            app.redis.xadd(stream, {"token": "Boil", "count": 1})
+
+        async def main():
+            hub = StreamHub(Redis.from_url(app.config.REDIS_URL))
+            # every subscription is in place before the hub first reads
+            subscriptions = [hub.subscribe(stream) for stream in streams]
+            await asyncio.wait_for(
+                asyncio.gather(*(s.get() for s in subscriptions)), 5
+            )
+            await hub.close()
+            return hub.hits
+
+        assert asyncio.run(main()) == 1
+        app.redis.delete(*streams)
+
+    @pytest.mark.benchmark
+    def test_fan_out_ceiling(self, user: "User", access_token: str):
+        pytest.importorskip("uvicorn")
+        # the most a round of tokens may take to reach every client
+        budget = 0.1
+        ceiling = 0
+        rounds = 5
+        for clients in (100, 500, 1000, 2000, 5000):
+            latency, hits = time_gateway_fan_out(
+                user, access_token, clients, rounds
+            )
+            print(
+                f"fan out ({clients} connections): {latency * 1000:.2f}ms, "
+                f"{hits} reads with entries"
+            )
+            # a round reaches every client in a read or two, not one each
+            assert hits <= 2 * rounds
+            if latency <= budget:
+                ceiling = clients
+        print(f"fan out: up to {ceiling} clients within {budget * 1000:.0f}ms")
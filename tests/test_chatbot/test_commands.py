@@ -0,0 +1,45 @@
+import pytest
+
+from cookgpt.chatbot.cli import count_chat_tokens, reconcile_threads
+from cookgpt.chatbot.models import Thread
+from tests.utils import Random, seed_chats
+
+
+@pytest.mark.usefixtures("app")
+class TestReconcileThreads:
+    """test `chat reconcile-threads`"""
+
+    def test_reconcile(self, thread: "Thread"):
+        """test that drifted aggregates are recomputed"""
+        for i in range(3):
+            Random.chat(thread_id=thread.id, order=i, cost=10)
+        thread.update(cost_total=0, chat_count=0, last_chat_id=None)
+
+        with pytest.raises(SystemExit) as excinfo:
+            reconcile_threads.main(["-b", "1"])
+        assert excinfo.value.code == 0
+        assert thread.cost == 30
+        assert thread.chat_count == 3
+        assert thread.last_chat_id is not None
+
+
+@pytest.mark.usefixtures("app")
+class TestCountChatTokens:
+    """test `chat count-chat-tokens`"""
+
+    def test_count(self, thread: "Thread"):
+        """test that the chats without token counts are counted"""
+        from cookgpt.chatbot.models import Chat
+        from cookgpt.ext.cache import cache
+
+        seed_chats(thread.id, 5)
+        cache.clear()
+        with pytest.raises(SystemExit) as excinfo:
+            count_chat_tokens.main(["-b", "2"])
+        assert excinfo.value.code == 0
+        chats = Chat.query.filter(Chat.thread_id == thread.id).all()
+        assert all(chat.content_tokens for chat in chats)
+        # the counts are cached for the prompts again
+        assert cache.get(f"chat:{chats[0].id}:cost") == (
+            chats[0].content_tokens
+        )
@@ -0,0 +1,226 @@
+import asyncio
+import json
+from typing import TYPE_CHECKING, Optional
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from cookgpt.chatbot.gateway import StreamGateway, StreamHub
+from cookgpt.chatbot.utils import get_stream_name
+from cookgpt.globals import current_app as app
+from tests.utils import Random, parse_events
+
+if TYPE_CHECKING:
+    from cookgpt.chatbot.models import Chat, Thread
+
+
+class Client:
+    """sends requests to the gateway like an ASGI server would"""
+
+    def __init__(self, gateway: "StreamGateway"):
+        self.gateway = gateway
+
+    async def get(
+        self,
+        path: str,
+        token: Optional[str] = None,
+        headers: "Optional[dict[str, str]]" = None,
+        disconnect: "Optional[asyncio.Event]" = None,
+    ) -> "tuple[int, str]":
+        headers = dict(headers or {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"",
+            "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+        }
+        disconnect = disconnect or asyncio.Event()
+        messages: "list[dict]" = []
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {
+                    "type": "http.request",
+                    "body": b"",
+                    "more_body": False,
+                }
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict):
+            messages.append(message)
+
+        await self.gateway(scope, receive, send)
+        body = b"".join(m.get("body", b"") for m in messages[1:])
+        return messages[0]["status"], body.decode()
+
+
+def start_streaming(chat: "Chat", thread: "Thread") -> str:
+    """mark a response as being streamed and return its stream"""
+    stream = get_stream_name(thread.user, chat)
+    app.redis.set(f"{stream}:task", "task-id")
+    return stream
+
+
+class TestStreamGateway:
+    def test_events(self, thread: "Thread", access_token: str):
+        _, r = thread.add_exchange()
+        stream = start_streaming(r, thread)
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            request = asyncio.create_task(
+                client.get(f"/chat/stream/{r.id}/events", access_token)
+            )
+            # the client is waiting before the first token is streamed
+            await asyncio.sleep(0.2)
+            app.redis.xadd(stream, {"token": "Boil the", "count": 2})
+            app.redis.xadd(stream, {"token": " egg", "count": 1})
+            app.redis.xadd(stream, {"event": "end"})
+            return await asyncio.wait_for(request, 5)
+
+        status, body = asyncio.run(main())
+        assert status == 200
+        events = parse_events(body)
+        assert [e["event"] for e in events] == ["token", "token", "done"]
+        assert json.loads(events[1]["data"]) == {"token": " egg", "count": 1}
+        assert json.loads(events[2]["data"])["id"] == str(r.id)
+
+        # a reconnecting client only gets the events it missed
+        async def resume():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return await client.get(
+                f"/chat/stream/{r.id}/events",
+                access_token,
+                headers={"Last-Event-ID": events[0]["id"]},
+            )
+
+        status, body = asyncio.run(resume())
+        assert parse_events(body) == events[1:]
+
+    def test_tokens(self, thread: "Thread", access_token: str):
+        _, r = thread.add_exchange()
+        stream = start_streaming(r, thread)
+        app.redis.xadd(stream, {"token": "Boil the", "count": 2})
+        app.redis.xadd(stream, {"token": " egg", "count": 1})
+        app.redis.xadd(stream, {"event": "end"})
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return await client.get(f"/chat/stream/{r.id}", access_token)
+
+        assert asyncio.run(main()) == (200, "Boil the egg")
+
+    def test_authentication(self, thread: "Thread", access_token: str):
+        _, r = thread.add_exchange()
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return [
+                (await client.get(f"/chat/stream/{r.id}"))[0],
+                (await client.get(f"/chat/stream/{r.id}", "invalid"))[0],
+                (await client.get("/chat/threads", access_token))[0],
+            ]
+
+        assert asyncio.run(main()) == [401, 401, 404]
+
+    def test_another_users_chat(self, thread: "Thread"):
+        _, r = thread.add_exchange()
+        token = Random.user().create_token().access_token
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return await client.get(f"/chat/stream/{r.id}/events", token)
+
+        assert asyncio.run(main())[0] == 403
+
+    def test_refresh_token(self, thread: "Thread"):
+        _, r = thread.add_exchange()
+        token = thread.user.create_token()
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return await client.get(
+                f"/chat/stream/{r.id}", token.refresh_token
+            )
+
+        assert asyncio.run(main())[0] == 401
+
+    def test_revoked_token(self, thread: "Thread"):
+        _, r = thread.add_exchange()
+        token = thread.user.create_token()
+        thread.user.revoke_token(token)
+
+        async def main():
+            client = Client(
+                StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            )
+            return await client.get(f"/chat/stream/{r.id}", token.access_token)
+
+        assert asyncio.run(main())[0] == 401
+
+    def test_disconnect(self, thread: "Thread", access_token: str):
+        _, r = thread.add_exchange()
+        stream = start_streaming(r, thread)
+
+        async def main():
+            gateway = StreamGateway(app, Redis.from_url(app.config.REDIS_URL))
+            disconnect = asyncio.Event()
+            request = asyncio.create_task(
+                Client(gateway).get(
+                    f"/chat/stream/{r.id}/events",
+                    access_token,
+                    disconnect=disconnect,
+                )
+            )
+            await asyncio.sleep(0.2)
+            assert stream in gateway.hub.subscriptions
+            disconnect.set()
+            await asyncio.wait_for(request, 5)
+            return gateway.hub.subscriptions
+
+        assert asyncio.run(main()) == {}
+
+
+class TestStreamHub:
+    def test_slow_subscriber(self):
+        stream = f"stream:{uuid4().hex}"
+        for i in range(10):
+            app.redis.xadd(stream, {"token": str(i), "count": 1})
+
+        async def main():
+            hub = StreamHub(
+                Redis.from_url(app.config.REDIS_URL), block_ms=10, queue_size=4
+            )
+            subscription = hub.subscribe(stream)
+            await asyncio.sleep(0.1)
+            # the queue is full, the subscriber is paused
+            assert subscription.paused
+            assert subscription.queue.qsize() == 4
+            tokens = []
+            for _ in range(10):
+                _, entry = await asyncio.wait_for(subscription.get(), 1)
+                tokens.append(entry[b"token"].decode())
+            subscription.close()
+            await hub.close()
+            return tokens
+
+        assert asyncio.run(main()) == [str(i) for i in range(10)]
@@ -0,0 +1,296 @@
+from typing import TYPE_CHECKING
+
+from cookgpt.chatbot.memory import SingleThreadHistory, get_memory_input_key
+from cookgpt.globals import resetvar, setvar
+from tests.utils import count_queries, seed_chats
+
+if TYPE_CHECKING:
+    from cookgpt.chatbot.models import Thread
+
+
+class TestSingleThreadHistory:
+    def test_one_history_query_per_generation(
+        self, thread: "Thread", monkeypatch
+    ):
+        from cookgpt.chatbot.tasks import send_query
+
+        calls = []
+        get_messages = SingleThreadHistory.get_messages
+
+        def counted_get_messages(self):
+            calls.append(self)
+            return get_messages(self)
+
+        monkeypatch.setattr(
+            SingleThreadHistory, "get_messages", counted_get_messages
+        )
+        seed_chats(thread.id, 10)
+        for generation in range(1, 3):
+            q, r = thread.add_exchange()
+            send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+            assert len(calls) == generation
+
+    def test_one_history_query_per_load(self, thread: "Thread", monkeypatch):
+        from cookgpt.chatbot.memory import ThreadMemory
+
+        calls = []
+        get_messages = SingleThreadHistory.get_messages
+
+        def counted_get_messages(self):
+            calls.append(self)
+            return get_messages(self)
+
+        monkeypatch.setattr(
+            SingleThreadHistory, "get_messages", counted_get_messages
+        )
+        seed_chats(thread.id, 4)
+        q, r = thread.add_exchange()
+        setvar("thread", thread)
+        setvar("query", q)
+        setvar("response", r)
+        setvar("user", thread.user)
+        setvar("chat_cost", (3, 4))
+        try:
+            memory = ThreadMemory()
+            memory.load_memory_variables({})
+            memory.buffer
+            memory.buffer_as_messages
+            memory.save_context(
+                {get_memory_input_key(): "Hi"}, {"response": "Hello"}
+            )
+            messages = memory.chat_memory.messages
+            assert len(calls) == 1
+            assert [m.content for m in messages[-2:]] == ["Hi", "Hello"]
+            assert messages[-1].additional_kwargs["id"] == r.pk
+        finally:
+            resetvar("thread")
+            resetvar("query")
+            resetvar("response")
+            resetvar("user")
+
+    def test_snapshot(self, thread: "Thread"):
+        seed_chats(thread.id, 4)
+        setvar("thread", thread)
+        try:
+            history = SingleThreadHistory()
+            assert len(history.messages) == 4
+            # the snapshot is reused until it is reloaded
+            thread.add_query("Hi")
+            assert len(history.messages) == 4
+            history.load_messages(reload=True)
+            assert len(history.messages) == 5
+            assert history.messages[-1].content == "Hi"
+        finally:
+            resetvar("thread")
+
+
+class TestWindowThreadHistory:
+    def test_token_budget(self, thread: "Thread"):
+        from cookgpt.chatbot.memory import WindowThreadHistory
+
+        seed_chats(thread.id, 10)
+        setvar("thread", thread)
+        try:
+            everything = SingleThreadHistory().get_messages()
+            history = WindowThreadHistory(max_tokens=10**6)
+            costs = history.get_message_costs(everything)
+            assert [m.content for m in history.get_messages()] == [
+                m.content for m in everything
+            ]
+
+            history = WindowThreadHistory(max_tokens=sum(costs[-3:]))
+            assert [m.content for m in history.get_messages()] == [
+                m.content for m in everything[-3:]
+            ]
+            history = WindowThreadHistory(max_tokens=sum(costs[-3:]) - 1)
+            assert len(history.get_messages()) == 2
+        finally:
+            resetvar("thread")
+
+    def test_fetches_needed_rows(self, thread: "Thread"):
+        from cookgpt.chatbot.memory import WindowThreadHistory
+
+        seed_chats(thread.id, 50)
+        setvar("thread", thread)
+        try:
+            history = WindowThreadHistory(max_tokens=10**6, page_size=5)
+            costs = history.get_message_costs(history.get_messages())
+            history.max_tokens = sum(costs[-7:])
+            with count_queries() as statements:
+                messages = history.get_messages()
+            assert len(messages) == 7
+            # two pages of 5 rows
+            assert len(statements) == 2
+        finally:
+            resetvar("thread")
+
+    def test_get_memory(self):
+        from cookgpt.chatbot.memory import (
+            ThreadMemory,
+            WindowThreadMemory,
+            get_memory,
+        )
+        from cookgpt.ext.config import config
+
+        assert type(get_memory()) is ThreadMemory
+        config.set("CHATBOT_MEMORY_TYPE", "window")
+        try:
+            assert type(get_memory()) is WindowThreadMemory
+        finally:
+            config.set("CHATBOT_MEMORY_TYPE", "thread")
+
+
+class TestSummaryMemory:
+    def test_summarize(self, thread: "Thread"):
+        from cookgpt.chatbot.memory import ThreadSummarizer
+
+        seed_chats(thread.id, 12)
+        summarizer = ThreadSummarizer(recent_turns=2)
+        assert summarizer.summarize(thread)
+        assert thread.summary
+        # the last 2 turns are not summarized
+        assert thread.summary_order == 7
+        assert not summarizer.summarize(thread)
+
+        summarizer.batch_size = 2
+        thread.add_exchange("Hi", "Hello")
+        assert summarizer.summarize(thread)
+        assert thread.summary_order == 9
+
+    def test_summary_history(self, thread: "Thread"):
+        from langchain.schema import SystemMessage
+
+        from cookgpt.chatbot.memory import SummaryThreadHistory
+
+        seed_chats(thread.id, 12)
+        setvar("thread", thread)
+        try:
+            history = SummaryThreadHistory(recent_turns=2)
+            messages = history.get_messages()
+            assert len(messages) == 4
+
+            thread.set_summary("The human is hungry.", 7)
+            messages = history.get_messages()
+            assert len(messages) == 5
+            assert isinstance(messages[0], SystemMessage)
+            assert "The human is hungry." in messages[0].content
+        finally:
+            resetvar("thread")
+
+    def test_delete_summarized_chats(self, thread: "Thread"):
+        seed_chats(thread.id, 12)
+        thread.set_summary("The human is hungry.", 7)
+        thread.delete_chats(10)
+        assert thread.summary_order == 7
+        thread.delete_chats(5)
+        assert thread.summary == ""
+        assert thread.summary_order == -1
+
+    def test_replaced_summary_cost_is_dropped(self, thread: "Thread"):
+        from cookgpt.chatbot.history import get_summary_id
+        from cookgpt.ext import cache
+
+        def cost_key(order: int) -> str:
+            return f"chat:{get_summary_id(thread.id, order)}:cost"
+
+        seed_chats(thread.id, 12)
+        thread.set_summary("The human is hungry.", 3)
+        cache.set(cost_key(3), 5, timeout=0)
+        thread.set_summary("The human wants eggs.", 7)
+        assert cache.get(cost_key(3)) is None
+        cache.set(cost_key(7), 5, timeout=0)
+        thread.delete_chats(5)
+        assert cache.get(cost_key(7)) is None
+
+    def test_send_query_schedules_summary(self, thread: "Thread", monkeypatch):
+        from cookgpt.chatbot.tasks import send_query, summarize_thread
+        from cookgpt.ext import db
+        from cookgpt.ext.config import config
+
+        scheduled = []
+        monkeypatch.setattr(summarize_thread, "delay", scheduled.append)
+        seed_chats(thread.id, 12)
+        thread.set_summary("The human is hungry.", 3)
+        config.set("CHATBOT_MEMORY_TYPE", "summary")
+        try:
+            q, r = thread.add_exchange()
+            send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+        finally:
+            config.set("CHATBOT_MEMORY_TYPE", "thread")
+        assert scheduled == [thread.id]
+        # the 4 most recent turns are kept as they are
+        assert summarize_thread(thread.id)
+        db.session.refresh(thread)
+        assert thread.summary_order == 5
+
+
+class TestHotHistory:
+    def test_history_list(self, thread: "Thread"):
+        from cookgpt.chatbot.history import get_history_key, load_history
+        from cookgpt.chatbot.tasks import send_query
+        from cookgpt.globals import current_app as app
+
+        seed_chats(thread.id, 6)
+        setvar("thread", thread)
+        try:
+            assert load_history(thread.id) is None
+            messages = SingleThreadHistory().get_messages()
+            assert len(load_history(thread.id) or []) == 6
+            assert app.redis.ttl(get_history_key(thread.id)) > 0
+
+            with count_queries() as statements:
+                cached = SingleThreadHistory().get_messages()
+            assert not statements
+            assert cached == messages
+        finally:
+            resetvar("thread")
+
+        # saved messages are written through
+        q, r = thread.add_exchange()
+        send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+        entries = load_history(thread.id) or []
+        assert len(entries) == 8
+        assert [e[0] for e in entries[-2:]] == [q.sid, r.sid]
+        assert entries[-2][2] == "Hi"
+        # with the token counts cached by the callback
+        assert all(e[3] for e in entries[-2:])
+
+    def test_content_tokens(self, thread: "Thread"):
+        from cookgpt.chatbot.history import forget_history
+        from cookgpt.chatbot.tasks import send_query
+        from cookgpt.ext import db
+        from cookgpt.ext.cache import cache
+
+        q, r = thread.add_exchange()
+        send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+        db.session.refresh(q)
+        db.session.refresh(r)
+        assert q.content_tokens and r.content_tokens
+        assert cache.get(f"chat:{q.id}:cost") == q.content_tokens
+
+        # the counts outlive the cache
+        cache.clear()
+        forget_history(thread.id)
+        setvar("thread", thread)
+        try:
+            entries = SingleThreadHistory().get_history_entries()
+        finally:
+            resetvar("thread")
+        assert [e[3] for e in entries] == [q.content_tokens, r.content_tokens]
+
+    def test_history_invalidation(self, thread: "Thread"):
+        from cookgpt.chatbot.history import load_history
+
+        seed_chats(thread.id, 6)
+        setvar("thread", thread)
+        try:
+            SingleThreadHistory().get_messages()
+            thread.add_query("Hi")
+            assert load_history(thread.id) is None
+            assert len(SingleThreadHistory().get_messages()) == 7
+
+            thread.delete_chats(4)
+            assert load_history(thread.id) is None
+            assert len(SingleThreadHistory().get_messages()) == 4
+        finally:
+            resetvar("thread")
@@ -0,0 +1,220 @@
+from typing import TYPE_CHECKING
+from uuid import uuid4
+
+from cookgpt.chatbot.data.prompts import (
+    render_system_prompt,
+    split_system_prompt,
+    system_prompt,
+    system_prompt_hash,
+    system_prompt_template,
+)
+from cookgpt.chatbot.utils import (
+    clear_token_counts,
+    count_message_tokens,
+    count_tokens,
+    get_system_prompt_parts_tokens,
+    get_system_prompt_tokens,
+    num_tokens_from_messages,
+)
+from cookgpt.ext.cache import cache
+from cookgpt.globals import resetvar, setvar
+
+if TYPE_CHECKING:
+    from cookgpt.auth.models import User
+
+
+class TestSystemPrompt:
+    def test_render(self):
+        message = system_prompt_template.format(user="Ada")
+        assert message.content == system_prompt.replace("{user}", "Ada")
+        assert render_system_prompt("Ada") is message.content
+
+    def test_static_tokens_cached_by_template(self):
+        get_system_prompt_parts_tokens.cache_clear()
+        key = f"system_prompt:{system_prompt_hash}:static_tokens"
+        cache.delete(key)
+        tokens = get_system_prompt_parts_tokens()
+        assert cache.get(key) == tokens
+
+    def test_new_user_only_encodes_name(self, monkeypatch):
+        from cookgpt.chatbot import utils
+
+        get_system_prompt_parts_tokens()
+        encoded = []
+        encode = utils.get_encoding().encode
+
+        def counted_encode(text, *args, **kwargs):
+            encoded.append(text)
+            return encode(text, *args, **kwargs)
+
+        monkeypatch.setattr(utils.get_encoding(), "encode", counted_encode)
+        get_system_prompt_tokens.cache_clear()
+        get_system_prompt_tokens("Grace")
+        # the static parts of the template are not encoded again
+        assert encoded[0] == "system"
+        assert all("Grace" in text for text in encoded[1:])
+
+        encoded.clear()
+        get_system_prompt_tokens("Grace")
+        assert not encoded
+
+    def test_exact_count(self):
+        from cookgpt.chatbot.utils import get_encoding
+
+        encode = get_encoding().encode
+        names = ("John", "Mary Ann", "O'Brien", "Zoë", "J.R.")
+        for name in names:
+            get_system_prompt_tokens.cache_clear()
+            content = render_system_prompt(name)
+            assert get_system_prompt_tokens(name) == (
+                len(encode(content)) + 4 + len(encode("system"))
+            ), name
+
+        # punctuation after the name is merged with the newlines after it
+        for template in (
+            "Cook for {user}.\nAsk {user} first.",
+            'Call them "{user}"\n\nand be kind.',
+            "Dear {user},\r\n  thanks",
+        ):
+            static_parts, name_words = split_system_prompt(template)
+            for name in names:
+                counted = sum(len(encode(p)) for p in static_parts) + sum(
+                    len(encode(w.replace("{user}", name))) for w in name_words
+                )
+                content = template.replace("{user}", name)
+                assert counted == len(encode(content)), (template, name)
+
+    def test_num_tokens(self, user: "User"):
+        from cookgpt.chatbot.utils import get_encoding
+
+        encode = get_encoding().encode
+        content = render_system_prompt(user.first_name)
+        setvar("user", user)
+        try:
+            tokens = num_tokens_from_messages(
+                [{"role": "system", "content": content}]
+            )
+        finally:
+            resetvar("user")
+        # every reply is primed with <im_start>assistant
+        assert tokens == len(encode(content)) + 4 + len(encode("system")) + 2
+
+
+class TestCountMessageTokens:
+    def test_batched_lookups(self, user: "User", monkeypatch):
+        messages = [
+            {
+                "role": "system",
+                "content": render_system_prompt(user.first_name),
+            }
+        ] + [
+            {"role": role, "content": f"message {i}", "id": uuid4().hex}
+            for i, role in enumerate(["user", "assistant"] * 5)
+        ]
+        get_system_prompt_parts_tokens()
+        calls = []
+        for name in ("get", "has", "get_many", "set", "set_many"):
+            method = getattr(cache, name)
+            monkeypatch.setattr(
+                cache,
+                name,
+                lambda *a, name=name, method=method, **kw: (
+                    calls.append(name) or method(*a, **kw)
+                ),
+            )
+        setvar("user", user)
+        try:
+            first = count_message_tokens(messages)
+            assert (first.hits, first.misses) == (1, 10)
+            assert calls == ["get_many", "set_many"]
+
+            calls.clear()
+            second = count_message_tokens(messages)
+            assert (second.hits, second.misses) == (11, 0)
+            assert calls == ["get_many"]
+        finally:
+            resetvar("user")
+        assert second.costs == first.costs
+        assert second.tokens == sum(first.costs) + 2
+
+    def test_ids_are_not_counted(self):
+        from cookgpt.chatbot import utils
+
+        clear_token_counts()
+        encode = utils.get_encoding().encode
+        messages = [
+            {"role": "user", "content": "Boil an egg", "id": uuid4().hex}
+            for _ in range(3)
+        ]
+        count = count_message_tokens(messages)
+        assert (
+            count.costs
+            == [4 + len(encode("user")) + len(encode("Boil an egg"))] * 3
+        )
+        # only the role and the content are kept in the LRU
+        assert len(utils._token_counts) == 2
+
+
+class TestCountTokens:
+    def test_lru(self, monkeypatch):
+        from cookgpt.chatbot import utils
+        from cookgpt.ext.config import config
+
+        clear_token_counts()
+        encoded = []
+        encode = utils.get_encoding().encode
+
+        def counted_encode(text, *args, **kwargs):
+            encoded.append(text)
+            return encode(text, *args, **kwargs)
+
+        monkeypatch.setattr(utils.get_encoding(), "encode", counted_encode)
+        monkeypatch.setattr(config, "TOKENIZER_CACHE_SIZE", 2)
+        counts = count_tokens(["one two", "three", "one two"])
+        assert counts == [
+            len(encode(t)) for t in ("one two", "three", "one two")
+        ]
+        # duplicates are encoded once
+        assert encoded == ["one two", "three"]
+
+        encoded.clear()
+        count_tokens(["four", "one two"])
+        assert encoded == ["four"]
+        # "three" was the least recently used
+        count_tokens(["three"])
+        assert encoded == ["four", "three"]
+
+    def test_batch(self, monkeypatch):
+        from cookgpt.chatbot import utils
+        from cookgpt.ext.config import config
+
+        clear_token_counts()
+        batches = []
+        encode_batch = utils.get_encoding().encode_batch
+
+        def counted_encode_batch(texts, *args, **kwargs):
+            batches.append(texts)
+            return encode_batch(texts, *args, **kwargs)
+
+        monkeypatch.setattr(
+            utils.get_encoding(), "encode_batch", counted_encode_batch
+        )
+        texts = [f"message {i}" for i in range(config.TOKENIZER_BATCH_SIZE)]
+        count_tokens(texts[:-1])
+        assert not batches
+        clear_token_counts()
+        count_tokens(texts)
+        assert batches == [texts]
+
+
+class TestTokenizer:
+    def test_lazy_loading(self):
+        from cookgpt.chatbot.utils import get_encoding, prewarm_tokenizer
+
+        get_encoding.cache_clear()
+        assert get_encoding.cache_info().currsize == 0
+        prewarm_tokenizer()
+        assert get_encoding.cache_info().currsize == 1
+        encoding = get_encoding()
+        prewarm_tokenizer()
+        assert get_encoding() is encoding
@@ -0,0 +1,136 @@
+"""
+Query plan regression tests.
+
+The hot chat queries are captured while running the code that issues them
+and each one is EXPLAINed against the test database. A test fails if any
+of them falls back to a full table (or full index) scan.
+"""
+from contextlib import contextmanager
+from typing import Any, Generator
+
+import pytest
+from sqlalchemy import event
+
+from cookgpt.auth.models import User
+from cookgpt.chatbot.models import Chat, Thread
+from cookgpt.ext import db
+from cookgpt.globals import resetvar, setvar
+from tests.utils import seed_chats
+
+Statements = list[tuple[str, Any]]
+
+
+@contextmanager
+def capture_statements() -> Generator[Statements, None, None]:
+    """capture the statements and parameters executed within the block"""
+    statements: Statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        if statement.split(None, 1)[0].upper() in {
+            "SELECT",
+            "UPDATE",
+            "DELETE",
+        }:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def full_scans(statement: str, parameters: Any) -> "list[str]":
+    """return the parts of the statement's plan that are full scans"""
+    dialect = db.engine.dialect.name
+    with db.engine.connect() as conn:
+        if dialect == "sqlite":
+            plan = conn.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters
+            ).all()
+            # SEARCH uses an index lookup, SCAN reads the whole table/index
+            return [
+                row.detail for row in plan if row.detail.startswith("SCAN")
+            ]
+        elif dialect == "mysql":  # pragma: no cover
+            plan = conn.exec_driver_sql(
+                f"EXPLAIN {statement}", parameters
+            ).mappings()
+            return [
+                f"{row['table']}: {row['type']}"
+                for row in plan
+                if row["type"] in ("ALL", "index")
+            ]
+    pytest.skip(f"EXPLAIN is not supported for {dialect}")  # pragma: no cover
+
+
+def assert_no_full_scans(statements: Statements):
+    """fail if any of the statements does a full scan"""
+    assert statements, "no statements were captured"
+    for statement, parameters in statements:
+        scans = full_scans(statement, parameters)
+        assert not scans, f"full scan {scans} in:\n{statement}"
+
+
+@pytest.fixture(scope="function")
+def long_thread(user: "User"):
+    """a thread with chats, next to another thread with chats"""
+    thread = user.create_thread(title="Long Thread")
+    other = user.create_thread(title="Other Thread")
+    seed_chats(thread.id, 200)
+    seed_chats(other.id, 200)
+    yield thread
+    thread.delete()
+    other.delete()
+
+
+class TestQueryPlans:
+    def test_get_messages(self, long_thread: "Thread"):
+        from cookgpt.chatbot.memory import SingleThreadHistory
+
+        setvar("thread", long_thread)
+        try:
+            with capture_statements() as statements:
+                SingleThreadHistory().get_messages()
+        finally:
+            resetvar("thread")
+        assert_no_full_scans(statements)
+
+    def test_get_chats(self, long_thread: "Thread"):
+        with capture_statements() as statements:
+            long_thread.get_chats(20)
+            long_thread.get_chats(20, before=100)
+            long_thread.get_chats(20, after=100)
+        assert_no_full_scans(statements)
+
+    def test_last_chat(self, long_thread: "Thread"):
+        db.session.expire_all()
+        with capture_statements() as statements:
+            chat = long_thread.last_chat
+            assert chat is not None
+            chat.previous_chat
+            chat.next_chat
+        assert_no_full_scans(statements)
+
+    def test_delete_chats(self, long_thread: "Thread"):
+        with capture_statements() as statements:
+            long_thread.delete_chats(150)
+            long_thread.clear()
+        assert_no_full_scans(statements)
+
+    def test_reconcile(self, long_thread: "Thread"):
+        with capture_statements() as statements:
+            Thread.reconcile([long_thread.id])
+        assert_no_full_scans(statements)
+
+    def test_active_threads(self, long_thread: "Thread", user: "User"):
+        with capture_statements() as statements:
+            user.get_active_threads()
+        assert_no_full_scans(statements)
+
+    def test_chat_lookup(self, long_thread: "Thread"):
+        chat = long_thread.last_chat
+        assert chat is not None
+        with capture_statements() as statements:
+            Chat.query.filter(Chat.id == chat.id).first()
+        assert_no_full_scans(statements)
@@ -0,0 +1,176 @@
+from uuid import uuid4
+
+from cookgpt.auth.models import User
+from cookgpt.chatbot.models import Thread
+from cookgpt.chatbot.quota import (
+    estimate_cost,
+    forget_used_tokens,
+    get_ledger_key,
+    reserve_tokens,
+    settle_tokens,
+)
+from cookgpt.globals import current_app as app
+from tests.utils import count_queries, seed_chats
+
+
+def ledger(user: "User") -> "dict[bytes, bytes]":
+    return app.redis.hgetall(get_ledger_key(user.id))
+
+
+class TestQuotaLedger:
+    def test_reserve_and_settle(self, user: "User", thread: "Thread"):
+        user.update(max_chat_cost=1000)
+        thread.add_exchange(query_cost=100, response_cost=50)
+
+        reservation = reserve_tokens(user, 300)
+        assert reservation is not None
+        # the ledger is seeded from the database
+        assert ledger(user)[b"used"] == b"150"
+        assert ledger(user)[b"reserved"] == b"300"
+
+        assert settle_tokens(user.id, reservation, 250)
+        assert ledger(user)[b"used"] == b"400"
+        assert ledger(user)[b"reserved"] == b"0"
+        assert f"r:{reservation}".encode() not in ledger(user)
+        # a reservation is only settled once
+        assert not settle_tokens(user.id, reservation, 0)
+
+    def test_reservations_count_towards_quota(self, user: "User"):
+        user.update(max_chat_cost=500)
+        reservations = [reserve_tokens(user, 200) for _ in range(3)]
+        assert all(reservations[:2])
+        assert reservations[2] is None
+
+        settle_tokens(user.id, reservations[0], 0)
+        assert reserve_tokens(user, 200) is not None
+
+    def test_reservation_must_fit(self, user: "User"):
+        user.update(max_chat_cost=500)
+        assert reserve_tokens(user, 499) is not None
+        # the ledger is one token under the limit
+        assert reserve_tokens(user, 2) is None
+        assert reserve_tokens(user, 1) is not None
+
+    def test_estimate_includes_history(self, user: "User", thread: "Thread"):
+        from sqlalchemy import update
+
+        from cookgpt.chatbot.models import Chat
+        from cookgpt.ext import db
+        from cookgpt.ext.config import config
+
+        seed_chats(thread.id, 100)
+        db.session.execute(
+            update(Chat)
+            .where(Chat.thread_id == thread.id)
+            .values(content_tokens=10)
+        )
+        db.session.commit()
+        estimate = estimate_cost(user, thread, "How long do I boil an egg?")
+        assert estimate > 1000 + config.MAX_RESPONSE_TOKENS
+
+        # the seeded chats cost a token each, there is only room for one
+        # reservation on this thread
+        user.update(max_chat_cost=100 + estimate * 2 - 1)
+        assert reserve_tokens(user, estimate) is not None
+        assert reserve_tokens(user, estimate) is None
+
+    def test_estimate_within_window(
+        self, user: "User", thread: "Thread", monkeypatch
+    ):
+        from cookgpt.ext.config import config
+
+        seed_chats(thread.id, 100)
+        full = estimate_cost(user, thread, "How long do I boil an egg?")
+        monkeypatch.setattr(config, "CHATBOT_MEMORY_TYPE", "window")
+        monkeypatch.setattr(config, "CHATBOT_MEMORY_MAX_TOKENS", 50)
+        window = estimate_cost(user, thread, "How long do I boil an egg?")
+        assert window < full
+        # the window is not summed from the thread
+        with count_queries() as queries:
+            estimate_cost(user, thread, "How long do I boil an egg?")
+        assert queries == []
+
+    def test_estimate_within_summary(
+        self, user: "User", thread: "Thread", monkeypatch
+    ):
+        from cookgpt.ext.config import config
+
+        query = "How long do I boil an egg?"
+        seed_chats(thread.id, 100)
+        full = estimate_cost(user, thread, query)
+        monkeypatch.setattr(config, "CHATBOT_MEMORY_TYPE", "summary")
+        monkeypatch.setattr(config, "CHATBOT_MEMORY_RECENT_TURNS", 2)
+        with count_queries() as queries:
+            recent = estimate_cost(user, thread, query)
+        assert recent < full
+        # only the recent turns are read, however long the thread is
+        assert len(queries) == 1
+        assert "LIMIT" in queries[0]
+
+        thread.set_summary("The human is hungry.", 95)
+        assert estimate_cost(user, thread, query) > recent
+
+    def test_estimate_from_history_list(self, user: "User", thread: "Thread"):
+        from cookgpt.chatbot.history import dump_entry, store_history
+        from cookgpt.chatbot.models import MessageType
+
+        query = "How long do I boil an egg?"
+        empty = estimate_cost(user, thread, query)
+        store_history(
+            thread.id,
+            [
+                dump_entry(uuid4(), MessageType.QUERY, "Hi", 5),
+                dump_entry(uuid4(), MessageType.RESPONSE, "Hello!", None),
+            ],
+        )
+        with count_queries() as queries:
+            # a message that was never counted costs a token per byte
+            assert estimate_cost(user, thread, query) == empty + 5 + 6
+        assert queries == []
+
+    def test_forget_used_tokens(self, user: "User", thread: "Thread"):
+        thread.add_exchange(query_cost=100, response_cost=50)
+        settle_tokens(user.id, reserve_tokens(user, 10) or "", 150)
+        assert ledger(user)[b"used"] == b"300"
+
+        forget_used_tokens(user.id)
+        assert b"used" not in ledger(user)
+        reserve_tokens(user, 10)
+        assert ledger(user)[b"used"] == b"150"
+
+    def test_delete_chats_refunds_tokens(self, user: "User", thread: "Thread"):
+        thread.add_exchange(query_cost=100, response_cost=50)
+        reserve_tokens(user, 10)
+        thread.clear()
+        reserve_tokens(user, 10)
+        assert ledger(user)[b"used"] == b"0"
+
+    def test_delete_archived_thread_refunds_tokens(self, user: "User"):
+        thread = user.create_thread(title="Archived")
+        thread.add_exchange(query_cost=100, response_cost=50)
+        thread.archive()
+        reserve_tokens(user, 10)
+        assert ledger(user)[b"used"] == b"150"
+        thread.delete()
+        reserve_tokens(user, 10)
+        assert ledger(user)[b"used"] == b"0"
+
+    def test_send_query_settles_reservation(
+        self, client, access_token: str, thread: "Thread"
+    ):
+        from flask import url_for
+
+        from cookgpt.ext import db
+
+        response = client.post(
+            url_for("chatbot.query", stream=False),
+            headers={"Authorization": f"Bearer {access_token}"},
+            json={"query": "test query", "thread_id": str(thread.id)},
+        )
+        assert response.status_code == 201
+        # the task updates the thread using its own session
+        db.session.refresh(thread)
+        assert thread.cost > 0
+        entries = ledger(thread.user)
+        assert entries[b"used"] == str(thread.cost).encode()
+        assert entries[b"reserved"] == b"0"
@@ -0,0 +1,77 @@
+from uuid import uuid4
+
+from cookgpt.chatbot.stream import StreamWriter
+from cookgpt.globals import current_app as app
+
+
+def new_stream() -> str:
+    """a stream name no other test run uses"""
+    return f"stream:{uuid4().hex}"
+
+
+def read(stream: str) -> "list[dict[bytes, bytes]]":
+    return [entry for _, entry in app.redis.xrange(stream)]
+
+
+class TestStreamWriter:
+    def test_flush_bytes(self):
+        stream = new_stream()
+        writer = StreamWriter(stream, flush_interval=60, flush_bytes=8)
+        for token in ("Boil", " the", " egg", " for", " ten"):
+            writer.write(token)
+        assert read(stream) == [
+            {b"token": b"Boil the", b"count": b"2"},
+            {b"token": b" egg for", b"count": b"2"},
+        ]
+
+        writer.close()
+        assert read(stream)[2:] == [
+            {b"token": b" ten", b"count": b"1"},
+            {b"event": b"end"},
+        ]
+        assert writer.tokens == 5
+        assert writer.entries == 3
+        assert writer.entries_saved == 2
+
+    def test_flush_interval(self, monkeypatch):
+        from cookgpt.chatbot import stream
+
+        now = [0.0]
+        monkeypatch.setattr(stream, "monotonic", lambda: now[0])
+        name = new_stream()
+        writer = StreamWriter(name, flush_interval=60, flush_bytes=1024)
+        writer.write("Boil")
+        now[0] += 10
+        writer.write(" the")
+        assert read(name) == []
+        now[0] += 60
+        writer.write(" egg")
+        assert read(name) == [{b"token": b"Boil the egg", b"count": b"3"}]
+        writer.close()
+
+    def test_flush_stalled_tokens(self):
+        from time import sleep
+
+        name = new_stream()
+        writer = StreamWriter(name, flush_interval=0.05, flush_bytes=1024)
+        writer.write("Boil")
+        writer.write(" the")
+        assert read(name) == []
+        # no other token arrives, the buffer is flushed by the timer
+        sleep(0.2)
+        assert read(name) == [{b"token": b"Boil the", b"count": b"2"}]
+        # a token after a quiet spell is flushed right away
+        writer.write(" egg")
+        assert read(name)[1:] == [{b"token": b" egg", b"count": b"1"}]
+        writer.close()
+
+    def test_close_with_error(self):
+        stream = new_stream()
+        writer = StreamWriter(stream, flush_interval=60)
+        writer.write("Boil")
+        writer.close(RuntimeError("rate limited"))
+        writer.close()
+        assert read(stream) == [
+            {b"token": b"Boil", b"count": b"1"},
+            {b"event": b"error", b"error": b"rate limited"},
+        ]
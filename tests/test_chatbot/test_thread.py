@@ -1,11 +1,14 @@
-from typing import cast
+from typing import TYPE_CHECKING, cast
 from uuid import uuid4
 
 import pytest
 
 from cookgpt.auth.models import User
 from cookgpt.chatbot.models import Chat, MessageType, Thread
-from tests.utils import Random
+from tests.utils import Random, count_queries
+
+if TYPE_CHECKING:
+    from cookgpt.app import App
 
 
 class TestThreadModel:
@@ -89,6 +92,25 @@ class TestThreadModel:
         assert response.previous_chat_id == query.id
         assert response.order == 1
 
+    def test_add_exchange(self, thread: Thread):
+        first = thread.add_query(content="Hi", cost=5, commit=True)
+        with count_queries() as statements:
+            query, response = thread.add_exchange(
+                "What's your name?", "", query_cost=5
+            )
+        assert not any(s.startswith("SELECT") for s in statements)
+
+        assert query.chat_type == MessageType.QUERY
+        assert query.previous_chat == first
+        assert query.order == 1
+        assert response.chat_type == MessageType.RESPONSE
+        assert response.previous_chat == query
+        assert query.next_chat == response
+        assert response.order == 2
+        assert thread.chat_count == 3
+        assert thread.cost == 10
+        assert thread.last_chat == response
+
     def test_close_thread(self, thread: Thread):
         thread.close()
         assert thread.closed is True
@@ -123,6 +145,159 @@ class TestThreadModel:
         thread.clear()
         assert len(thread.chats) == 0  # type: ignore
 
+    def test_delete_chats(self, thread: Thread, faker):
+        chats = [
+            thread.add_query(content=faker.sentence(), cost=5, commit=True)
+            for _ in range(5)
+        ]
+
+        assert thread.delete_chats(3) == 2
+        assert thread.chat_count == 3
+        assert thread.cost == 15
+        assert thread.last_chat == chats[2]
+        assert chats[2].next_chat is None
+        assert [c.id for c in thread.chats] == [c.id for c in chats[:3]]
+
+    def test_aggregates(self, thread: Thread):
+        query = thread.add_query(content="Hi", cost=5, commit=True)
+        response = thread.add_response(
+            content="Hello", cost=10, previous_chat=query, commit=True
+        )
+        assert thread.cost == 15
+        assert thread.chat_count == 2
+        assert thread.last_chat_id == response.id
+
+        response.update(cost=20)
+        assert thread.cost == 25
+
+        response.delete()
+        assert thread.cost == 5
+        assert thread.chat_count == 1
+        assert thread.last_chat_id == query.id
+
+    def test_reconcile(self, thread: Thread):
+        from cookgpt.ext import db
+
+        for i in range(4):
+            Random.chat(thread_id=thread.id, order=i, cost=5)
+        last = Random.chat(thread_id=thread.id, order=4, cost=5)
+        thread.update(cost_total=0, chat_count=0, last_chat_id=None)
+
+        assert Thread.reconcile([thread.id]) == 1
+        db.session.commit()
+        assert thread.cost == 25
+        assert thread.chat_count == 5
+        assert thread.last_chat_id == last.id
+
+    def test_archive(self, thread: Thread):
+        q, r = thread.add_exchange("Hi", "Hello", 5, 10)
+        expected = [(c.id, c.content, c.chat_type, c.order) for c in (q, r)]
+
+        assert thread.archive() == 2
+        assert thread.archived
+        assert thread.archived_chats is not None
+        assert thread.archived_chats.chat_count == 2
+        assert Chat.query.filter(Chat.thread_id == thread.id).count() == 0
+        # the chats still belong to the thread
+        assert thread.cost == 15
+        assert thread.chat_count == 2
+
+        assert thread.restore() == 2
+        assert not thread.archived
+        assert thread.archived_chats is None
+        chats = cast(list[Chat], thread.chats)
+        assert [(c.id, c.content, c.chat_type, c.order) for c in chats] == (
+            expected
+        )
+        assert chats[1].previous_chat_id == q.id
+        assert thread.last_chat_id == r.id
+
+    def test_concurrent_restore(self, app: "App", thread: Thread):
+        thread.add_exchange("Hi", "Hello")
+        thread.archive()
+        # both requests load the archived thread
+        assert thread.archived
+        assert thread.archived_chats is not None
+        # another request restores the thread after this one loaded it
+        with app.app_context():
+            assert Thread.query.get(thread.id).restore() == 2
+
+        assert thread.restore() == 0
+        assert not thread.archived
+        assert len(thread.chats) == 2  # type: ignore
+
+    def test_get_archived_thread(self, thread: Thread):
+        from cookgpt.chatbot.utils import get_thread
+
+        thread.add_exchange("Hi", "Hello")
+        thread.archive()
+
+        assert get_thread(thread.id, restore=False).archived
+        assert not get_thread(thread.id).archived
+        assert len(thread.chats) == 2  # type: ignore
+
+    def test_delete_archived_thread(self, user: "User"):
+        from cookgpt.chatbot.models import ThreadArchive
+
+        thread = user.create_thread(title="Archived")
+        thread.add_exchange("Hi", "Hello")
+        thread.archive()
+        thread.delete()
+        assert ThreadArchive.query.count() == 0
+
+    def test_clear_archived_thread(self, thread: Thread):
+        from cookgpt.chatbot.models import ThreadArchive
+
+        thread.add_exchange("Hi", "Hello", 5, 10)
+        thread.set_summary("The human said hi.", 1)
+        thread.archive()
+        assert thread.archived
+
+        thread.user.clear_chats([thread])
+        assert not thread.archived
+        assert thread.archived_chats is None
+        assert ThreadArchive.query.count() == 0
+        assert thread.cost == 0
+        assert thread.chat_count == 0
+        assert thread.last_chat_id is None
+        assert thread.summary_order == -1
+        # there is nothing left to restore
+        assert thread.restore() == 0
+        assert thread.chats == []
+
+    def test_delete_archived_chats_from_order(self, thread: Thread):
+        kept = [chat.id for chat in thread.add_exchange("Hi", "Hello", 5, 10)]
+        thread.add_exchange("Boil an egg", "Sure", 5, 10)
+        thread.archive()
+
+        assert thread.delete_chats(2) == 2
+        assert not thread.archived
+        assert [c.id for c in thread.chats] == kept  # type: ignore
+        assert thread.cost == 15
+        assert thread.chat_count == 2
+
+    def test_archive_threads_task(self, user: "User"):
+        from cookgpt.chatbot.tasks import archive_threads
+        from cookgpt.ext import db
+
+        closed = user.create_thread(title="Closed")
+        closed.add_exchange("Hi", "Hello")
+        closed.close()
+        active = user.create_thread(title="Active")
+        active.add_exchange("Hi", "Hello")
+        empty = user.create_thread(title="Empty")
+        empty.close()
+
+        assert archive_threads(batch_size=1) == 1
+        db.session.expire_all()
+        assert closed.archived
+        assert not active.archived
+        assert not empty.archived
+        # threads that have not been touched for a while are archived too
+        assert archive_threads(idle_days=-1) == 1
+        db.session.expire_all()
+        assert active.archived
+
 
 class TestThreadMixin:
     def test_create_thread(self, user: "User"):
@@ -9,7 +9,7 @@ from cookgpt.app import App
 from cookgpt.chatbot.data.enums import MessageType
 from cookgpt.chatbot.models import Chat, Thread
 from cookgpt.chatbot.utils import get_thread
-from tests.utils import Random
+from tests.utils import Random, count_queries, parse_events, seed_chats
 
 
 class TestChatsView:
@@ -43,6 +43,115 @@ class TestChatsView:
         assert chat["previous_chat_id"] is None
         assert chat["next_chat_id"] is None
 
+    def test_get_chats_paginated(
+        self, client: "FlaskClient", auth_header: dict, thread: "Thread"
+    ):
+        """Test that chats can be paged through using cursors"""
+        seed_chats(thread.id, 5)
+        response = client.get(
+            url_for("chatbot.all_chats", thread_id=thread.id, limit=2),
+            headers=auth_header,
+        )
+        assert response.status_code == 200
+        assert response.json is not None
+        orders = [chat.order for chat in cast(list[Chat], thread.chats)]
+        ids = [str(chat.id) for chat in cast(list[Chat], thread.chats)]
+        assert [c["id"] for c in response.json["chats"]] == ids[3:]
+        assert response.json["next_cursor"] == orders[3]
+
+        response = client.get(
+            url_for(
+                "chatbot.all_chats",
+                thread_id=thread.id,
+                limit=2,
+                before=response.json["next_cursor"],
+            ),
+            headers=auth_header,
+        )
+        assert response.json is not None
+        assert [c["id"] for c in response.json["chats"]] == ids[1:3]
+
+        response = client.get(
+            url_for(
+                "chatbot.all_chats",
+                thread_id=thread.id,
+                limit=2,
+                before=response.json["next_cursor"],
+            ),
+            headers=auth_header,
+        )
+        assert response.json is not None
+        assert [c["id"] for c in response.json["chats"]] == ids[:1]
+        assert response.json["next_cursor"] is None
+
+        response = client.get(
+            url_for(
+                "chatbot.all_chats", thread_id=thread.id, limit=3, after=0
+            ),
+            headers=auth_header,
+        )
+        assert response.json is not None
+        assert [c["id"] for c in response.json["chats"]] == ids[1:4]
+        assert response.json["next_cursor"] == orders[3]
+
+    def test_get_chats_constant_queries(
+        self, client: "FlaskClient", auth_header: dict, thread: "Thread"
+    ):
+        """Test that the number of queries doesn't depend on page size"""
+        from cookgpt.ext import cache
+
+        seed_chats(thread.id, 60)
+        counts = []
+        for limit in (1, 5, 50):
+            cache.clear()
+            with count_queries() as statements:
+                response = client.get(
+                    url_for(
+                        "chatbot.all_chats", thread_id=thread.id, limit=limit
+                    ),
+                    headers=auth_header,
+                )
+            assert len(cast(dict, response.json)["chats"]) == limit
+            counts.append(len(statements))
+        # the first request also loads the user and its token
+        assert counts[1] == counts[2]
+
+    def test_get_chats_page_cache_invalidation(
+        self, client: "FlaskClient", auth_header: dict, thread: "Thread"
+    ):
+        """Test that cached pages are invalidated when a chat is added"""
+        url = url_for("chatbot.all_chats", thread_id=thread.id)
+        thread.add_query("Hi")
+        response = client.get(url, headers=auth_header)
+        assert len(cast(dict, response.json)["chats"]) == 1
+        thread.add_response("Hello")
+        response = client.get(url, headers=auth_header)
+        assert len(cast(dict, response.json)["chats"]) == 2
+
+    def test_get_chats_ignores_cached_responses(
+        self, app: "App", thread: "Thread"
+    ):
+        """Test that the responses cached before paging aren't a version"""
+        from cookgpt.ext.cache import cache, chats_page_cache_key
+
+        # how the whole response used to be cached
+        cache.set(f"chats:{thread.id}", {"chats": []}, timeout=0)
+        with app.test_request_context(query_string={"limit": 10}):
+            key = chats_page_cache_key(thread_id=thread.id)
+        assert "chats" not in key.split(":", 2)[2]
+
+    def test_get_chats_before_and_after(
+        self, client: "FlaskClient", auth_header: dict, thread: "Thread"
+    ):
+        """Test that `before` and `after` can't be used together"""
+        response = client.get(
+            url_for(
+                "chatbot.all_chats", thread_id=thread.id, before=4, after=1
+            ),
+            headers=auth_header,
+        )
+        assert response.status_code == 406
+
     def test_delete_all_chats_in_thread(
         self, client: "FlaskClient", access_token: str, thread: "Thread"
     ):
@@ -452,3 +561,190 @@ class TestChatView:
 
 class TestChatStreaming:
     """Test the chat streaming view"""
+
+    def read(self, client: "FlaskClient", access_token: str, chat: "Chat"):
+        response = client.get(
+            url_for("chatbot.read_stream", chat_id=chat.id),
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        assert response.status_code == 200
+        return b"".join(cast(list[bytes], response.response)).decode()
+
+    def test_stream_ends_at_sentinel(
+        self,
+        app: "App",
+        client: "FlaskClient",
+        access_token: str,
+        thread: "Thread",
+    ):
+        """Test that the reader stops at the end of stream sentinel"""
+        from cookgpt.chatbot.utils import get_stream_name
+
+        _, r = thread.add_exchange()
+        stream = get_stream_name(thread.user, r)
+        app.redis.set(f"{stream}:task", "task-id")
+        for token in ("Boil ", "the ", "egg"):
+            app.redis.xadd(stream, {"token": token, "count": 1})
+        app.redis.xadd(stream, {"event": "end"})
+        # entries after the sentinel are never read
+        app.redis.xadd(stream, {"token": "!", "count": 1})
+
+        assert self.read(client, access_token, r) == "Boil the egg"
+
+    def test_stream_releases_connection(
+        self,
+        app: "App",
+        client: "FlaskClient",
+        access_token: str,
+        thread: "Thread",
+    ):
+        """Test that a stream doesn't hold a database connection"""
+        from cookgpt.chatbot.utils import get_stream_name
+        from cookgpt.ext import db
+
+        _, r = thread.add_exchange()
+        stream = get_stream_name(thread.user, r)
+        app.redis.set(f"{stream}:task", "task-id")
+        app.redis.xadd(stream, {"token": "Boil", "count": 1})
+        response = client.get(
+            url_for("chatbot.read_stream", chat_id=r.id),
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        # the response is waiting for its next token
+        assert not db.session().in_transaction()
+        app.redis.xadd(stream, {"token": " egg", "count": 1})
+        app.redis.xadd(stream, {"event": "end"})
+        assert b"".join(cast(list[bytes], response.response)) == b"Boil egg"
+
+    def test_callback_ends_stream(self, app: "App", thread: "Thread"):
+        """Test that the task ends the stream of the response"""
+        from cookgpt.chatbot.memory import get_memory_input_key
+        from cookgpt.chatbot.tasks import send_query
+        from cookgpt.chatbot.utils import get_stream_name
+        from cookgpt.ext import db
+
+        q, r = thread.add_exchange()
+        send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+        db.session.refresh(r)
+        stream = get_stream_name(thread.user, r)
+        entries = app.redis.xrange(stream)
+        assert entries[-1][1] == {b"event": b"end"}
+        tokens = [entry[b"token"] for _, entry in entries[:-1]]
+        assert b"".join(tokens).decode() == r.content
+
+    def test_callback_ends_stream_on_error(self, app: "App", thread: "Thread"):
+        """Test that a failed response ends its stream once with an error"""
+        from cookgpt.chatbot.callback import ChatCallbackHandler
+        from cookgpt.chatbot.utils import get_stream_name
+        from cookgpt.globals import resetvar, setvar
+
+        _, r = thread.add_exchange()
+        handler = ChatCallbackHandler()
+        setvar("response", r)
+        setvar("user", thread.user)
+        try:
+            handler.on_llm_error(RuntimeError("rate limited"))
+            handler.on_chain_error(RuntimeError("rate limited"))
+        finally:
+            resetvar("response")
+            resetvar("user")
+        entries = app.redis.xrange(get_stream_name(thread.user, r))
+        assert [entry for _, entry in entries] == [
+            {b"event": b"error", b"error": b"rate limited"}
+        ]
+
+
+class TestChatStreamEvents:
+    """Test the server-sent events stream view"""
+
+    def read(
+        self, client: "FlaskClient", chat: "Chat", access_token: str, **headers
+    ):
+        response = client.get(
+            url_for("chatbot.read_stream_events", chat_id=chat.id),
+            headers={"Authorization": f"Bearer {access_token}", **headers},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        return parse_events(response.get_data(as_text=True))
+
+    def test_events(
+        self, client: "FlaskClient", thread: "Thread", access_token: str
+    ):
+        """Test that the tokens are sent as events, followed by the chat"""
+        import json
+
+        from cookgpt.chatbot.memory import get_memory_input_key
+        from cookgpt.chatbot.tasks import send_query
+        from cookgpt.ext import db
+
+        q, r = thread.add_exchange()
+        send_query(q.id, r.id, thread.id, {get_memory_input_key(): "Hi"})
+        db.session.refresh(r)
+
+        events = self.read(client, r, access_token)
+        *tokens, done = events
+        assert {event["event"] for event in tokens} == {"token"}
+        content = "".join(json.loads(e["data"])["token"] for e in tokens)
+        assert content == r.content
+        assert done["event"] == "done"
+        chat = json.loads(done["data"])
+        assert chat["id"] == str(r.id)
+        assert chat["content"] == r.content
+        assert chat["cost"] == r.cost
+
+        # a reconnecting client resumes after the last event it received
+        resumed = self.read(
+            client, r, access_token, **{"Last-Event-ID": tokens[0]["id"]}
+        )
+        assert resumed == events[1:]
+
+    def test_pending_stream(
+        self,
+        app: "App",
+        client: "FlaskClient",
+        thread: "Thread",
+        access_token: str,
+    ):
+        """Test that a stream being written is read until its sentinel"""
+        import json
+
+        from cookgpt.chatbot.utils import get_stream_name
+
+        _, r = thread.add_exchange()
+        stream = get_stream_name(thread.user, r)
+        app.redis.set(f"{stream}:task", "task-id")
+        app.redis.xadd(stream, {"token": "Boil the", "count": 2})
+        app.redis.xadd(stream, {"event": "error", "error": "rate limited"})
+
+        events = self.read(
+            client, r, access_token, **{"Last-Event-ID": "not-an-id"}
+        )
+        assert [event["event"] for event in events] == ["token", "error"]
+        assert json.loads(events[0]["data"]) == {
+            "token": "Boil the",
+            "count": 2,
+        }
+        assert json.loads(events[1]["data"]) == {"error": "rate limited"}
+
+    def test_authentication(
+        self, client: "FlaskClient", thread: "Thread", access_token: str
+    ):
+        """Test that only the owner of a chat can read its events"""
+        _, r = thread.add_exchange()
+        url = url_for("chatbot.read_stream_events", chat_id=r.id)
+        assert client.get(url).status_code == 401
+        other = Random.user().create_token().access_token
+        response = client.get(
+            url, headers={"Authorization": f"Bearer {other}"}
+        )
+        assert response.status_code == 403
+        # an EventSource sends the token in the query string
+        response = client.get(
+            url_for(
+                "chatbot.read_stream_events",
+                chat_id=r.id,
+                access_token=access_token,
+            )
+        )
+        assert response.status_code == 200
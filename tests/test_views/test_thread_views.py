@@ -8,7 +8,7 @@ from flask.testing import FlaskClient
 from cookgpt.auth.models.user import User
 from cookgpt.chatbot.models import Chat, Thread
 from cookgpt.chatbot.utils import get_thread
-from tests.utils import Random
+from tests.utils import Random, count_queries, seed_chats
 
 
 @pytest.mark.usefixtures("user")
@@ -119,6 +119,30 @@ class TestThreadsView:
             assert thread["chat_count"] == 0
             assert thread["cost"] == 0
 
+    def test_get_threads_constant_queries(
+        self, client: FlaskClient, user: User, auth_header: dict
+    ):
+        """Test that the number of queries doesn't depend on the threads"""
+        from cookgpt.ext import cache
+
+        counts = []
+        for total in (1, 2, 20):
+            while len(user.get_active_threads()) < total:
+                thread = user.create_thread(title="Test Thread")
+                seed_chats(thread.id, 3)
+            cache.clear()
+            with count_queries() as statements:
+                response = client.get(
+                    url_for("chatbot.all_threads"), headers=auth_header
+                )
+            threads = cast(dict[str, list[dict]], response.json)["threads"]
+            assert len(threads) == total
+            assert all(t["chat_count"] == 3 for t in threads)
+            assert all(t["cost"] == 3 for t in threads)
+            counts.append(len(statements))
+        # the first request also loads the user and its token
+        assert counts[1] == counts[2]
+
     def test_delete_threads(
         self, client: FlaskClient, user: User, auth_header: dict
     ):
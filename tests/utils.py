@@ -30,6 +30,25 @@ def mock_config(config, **vars):
                 config[k] = v
 
 
+@contextmanager
+def count_queries():
+    """count the sql statements executed within the block"""
+    from sqlalchemy import event
+
+    from cookgpt.ext import db
+
+    statements: "list[str]" = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 class Random:
     """a namespace for random data"""
 
@@ -152,6 +171,39 @@ class Random:
         )
 
 
+def seed_chats(thread_id, count: int, cost: int = 1):
+    """bulk insert `count` linked chats into a thread"""
+    from uuid import uuid4
+
+    from sqlalchemy import insert
+
+    from cookgpt.chatbot.models import Chat, Thread
+    from cookgpt.ext import db
+
+    rows: "list[dict[str, Any]]" = []
+    previous_chat_id = None
+    for order in range(count):
+        chat_id = uuid4()
+        rows.append(
+            {
+                "id": chat_id,
+                "content": fake.sentence(),
+                "cost": cost,
+                "chat_type": MessageType.QUERY
+                if order % 2 == 0
+                else MessageType.RESPONSE,
+                "thread_id": thread_id,
+                "previous_chat_id": previous_chat_id,
+                "sent_time": utcnow(),
+                "order": order,
+            }
+        )
+        previous_chat_id = chat_id
+    db.session.execute(insert(Chat), rows)
+    Thread.reconcile([thread_id])
+    db.session.commit()
+
+
 def extract_cookie(response, name):
     """
     Extract's a set cookie from a server response
@@ -174,3 +226,17 @@ def extract_access_token(response):
     """extract access token from response"""
 
     return response.headers["Set-Cookie"].split(";")[0].split("=")[1]
+
+
+def parse_events(body: str) -> "list[dict[str, str]]":
+    """parse a server-sent events body, skipping comments"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(
+            line.split(": ", 1)
+            for line in block.splitlines()
+            if not line.startswith(":")
+        )
+        if fields:
+            events.append(fields)
+    return events
@@ -1,3 +1,11 @@
-from cookgpt import create_app_wsgi
+import os
+
+if os.getenv("GUNICORN_WORKER_CLASS") == "gevent":  # pragma: no cover
+    # in case the app is served without gunicorn.conf.py
+    from gevent import monkey
+
+    monkey.patch_all()
+
+from cookgpt import create_app_wsgi  # noqa: E402
 
 app = application = create_app_wsgi()  # noqa